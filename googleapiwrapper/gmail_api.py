@@ -1,11 +1,11 @@
+import hashlib
 import logging
 import sys
 import datetime
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
-from googleapiclient.discovery import build
 from pythoncommons.date_utils import timeit
 
 from googleapiwrapper.gmail_api_extensions import ApiFetchingContext
@@ -17,22 +17,35 @@ from googleapiwrapper.gmail_domain import (
     MessagePart,
     GmailMessageBodyPart,
     ThreadsResponseField,
-    MessagePartField,
-    MessagePartBodyField,
-    HeaderField,
     MessagePartBody,
-    Header,
     ThreadField,
     GetAttachmentParam,
-    MessageField,
     Thread,
     ListQueryParam,
     GmailThreads,
     GenericObjectHelper as GH,
     ThreadQueryFormat,
     ThreadQueryParam,
+    F_BODY_ATTACHMENT_ID,
+    F_BODY_DATA,
+    F_BODY_SIZE,
+    F_HEADER_NAME,
+    F_HEADER_VALUE,
+    F_MSG_DATE,
+    F_MSG_ID,
+    F_MSG_PAYLOAD,
+    F_MSG_SNIPPET,
+    F_MSG_THREAD_ID,
+    F_PART_BODY,
+    F_PART_HEADERS,
+    F_PART_ID,
+    F_PART_MIME_TYPE,
+    F_PART_PARTS,
+    F_THREAD_ID,
+    F_THREAD_MESSAGES,
 )
 from googleapiwrapper.google_auth import GoogleApiAuthorizer, AuthedSession
+from googleapiwrapper.utils import Decoder
 from pythoncommons.string_utils import auto_str
 
 CONV_CONTEXT_PREFIX = "[API Conversion context] "
@@ -97,6 +110,15 @@ class Progress:
 # TODO Move this object as a dependency of ApiFetchingContext
 @auto_str
 class ApiConversionContext:
+    # Quoted replies repeat the same body across the messages of a thread, keep the latest decoded bodies
+    DECODED_BODY_CACHE_SIZE = 1024
+    # Shorter bodies are cheaper to decode again than to keep around
+    DECODED_BODY_CACHE_MIN_LENGTH = 512
+    # Longer bodies are not cached, so a few large HTML bodies can't take over the cache
+    DECODED_BODY_CACHE_MAX_LENGTH = 256 * 1024
+    # Max. total length of the cached decoded bodies
+    DECODED_BODY_CACHE_MAX_TOTAL_LENGTH = 16 * 1024 * 1024
+
     def __init__(
         self,
         limit: int = None,
@@ -114,6 +136,9 @@ class ApiConversionContext:
         self.show_empty_body_errors = show_empty_body_errors
         self.decode_errors: List[MessagePartDescriptor] = []
         self.empty_bodies: List[MessagePartDescriptor] = []
+        # Key: digest of the base64 encoded body, value: decoded body. Oldest entries are evicted first.
+        self._decoded_bodies: Dict[bytes, str] = {}
+        self._decoded_bodies_total_length = 0
 
         # Set later
         self.threads: GmailThreads or None = None
@@ -126,6 +151,25 @@ class ApiConversionContext:
     def register_current_message_part(self, message_part: MessagePart):
         self.current_message_part = message_part
 
+    def decode_body(self, encoded_body_data: str) -> str:
+        if not self.DECODED_BODY_CACHE_MIN_LENGTH <= len(encoded_body_data) <= self.DECODED_BODY_CACHE_MAX_LENGTH:
+            return Decoder.decode_base64_urlsafe(encoded_body_data)
+        # Keyed by a digest, so the cache does not keep the encoded bodies alive as well
+        key = hashlib.blake2b(encoded_body_data.encode(), digest_size=16).digest()
+        decoded_body_data = self._decoded_bodies.get(key)
+        if decoded_body_data is not None:
+            return decoded_body_data
+        decoded_body_data = Decoder.decode_base64_urlsafe(encoded_body_data)
+        while self._decoded_bodies and (
+            len(self._decoded_bodies) >= self.DECODED_BODY_CACHE_SIZE
+            or self._decoded_bodies_total_length + len(decoded_body_data) > self.DECODED_BODY_CACHE_MAX_TOTAL_LENGTH
+        ):
+            evicted = self._decoded_bodies.pop(next(iter(self._decoded_bodies)))
+            self._decoded_bodies_total_length -= len(evicted)
+        self._decoded_bodies[key] = decoded_body_data
+        self._decoded_bodies_total_length += len(decoded_body_data)
+        return decoded_body_data
+
     def report_decode_error(self, thread_id: str, gmail_msg_body_part: GmailMessageBodyPart):
         self._log_error(
             f"Decoding error for thread with ID '{thread_id}'.\n"
@@ -236,9 +280,7 @@ class GmailWrapper:
         self.api_fetching_ctx: ApiFetchingContext = ApiFetchingContext(cache_strategy_obj)
         if not api_version:
             api_version = authorizer.service_type.default_api_version
-        self.service = build(
-            authorizer.service_type.service_name, api_version, credentials=self.authed_session.authed_creds
-        )
+        self.service = authorizer.build_service(self.authed_session, api_version)
         self.users_svc = self.service.users()
         self.messages_svc = self.users_svc.messages()
         self.threads_svc = self.users_svc.threads()
@@ -300,8 +342,8 @@ class GmailWrapper:
     def _fetch_thread_data_minimal(self, thread_id, ctx: ApiConversionContext) -> List[str]:
         # Try to query in minimal format first, hoping that some messages are already in cache
         thread_resp_minimal: Dict[str, Any] = self._fetch_thread_data(thread_id, ctx, format=ThreadQueryFormat.MINIMAL)
-        messages_response: List[Dict[str, Any]] = GH.get_field(thread_resp_minimal, ThreadField.MESSAGES)
-        message_ids: List[str] = [GH.get_field(msg, MessageField.ID) for msg in messages_response]
+        messages_response: List[Dict[str, Any]] = GH.get_field_value(thread_resp_minimal, F_THREAD_MESSAGES)
+        message_ids: List[str] = [GH.get_field_value(msg, F_MSG_ID) for msg in messages_response]
         return message_ids
 
     def _request_thread_or_load_from_cache(
@@ -322,16 +364,16 @@ class GmailWrapper:
 
         # Check if thread is now considered as fully cached, given the provided message IDs above
         if cache_state.is_fully_cached(thread_id):
-            thread_resp_full = self._get_item_from_cache(cache_state, thread_id)
-            loaded_from_cache = True
-        else:
-            # Not all messages for this thread are in cache.
+            thread_resp_full = self._get_item_from_cache(cache_state, thread_id, required=False)
+            loaded_from_cache = thread_resp_full is not None
+        if not loaded_from_cache:
+            # Not all messages for this thread are in cache, or the cached thread could not be loaded.
             # In this case, we need to retrieve the thread again, now with specified format
             thread_resp_full: Dict[str, Any] = self._fetch_thread_data(thread_id, ctx, format=ctx.format)
         return thread_resp_full, loaded_from_cache
 
     @staticmethod
-    def _get_item_from_cache(cache_state: CacheResultItems, item_id):
+    def _get_item_from_cache(cache_state: CacheResultItems, item_id, required: bool = True):
         ct = cache_state.cache_type
         ctc = cache_state.cache_type_capitalized
         thread_id_str = f"{ctc} ID: {item_id}"
@@ -340,11 +382,14 @@ class GmailWrapper:
         )
         thread_resp_full = cache_state.get_data_for_item(item_id)
         if not thread_resp_full:
+            if not required:
+                LOG.warning(f"{ctc} data could not be loaded from cache, requesting it from the API. {thread_id_str}")
+                return None
             raise ValueError(f"{ctc} data is None for {ct} ID '{item_id}'. Please check logs.")
         return thread_resp_full
 
     def _convert_to_thread_object(self, ctx, sanity_check: bool, thread_id: str, thread_resp_full):
-        messages_response: List[Dict[str, Any]] = GH.get_field(thread_resp_full, ThreadField.MESSAGES)
+        messages_response: List[Dict[str, Any]] = GH.get_field_value(thread_resp_full, F_THREAD_MESSAGES)
         messages: List[Message] = [self.parse_api_message(message) for message in messages_response]
 
         if sanity_check:
@@ -378,7 +423,7 @@ class GmailWrapper:
         )
         self._log_cache_state_details(cache_state, [message_id])
         if cache_state.is_fully_cached(message_id):
-            attachment_response = self._get_item_from_cache(cache_state, thread_id)
+            attachment_response = self._get_item_from_cache(cache_state, message_id)
         else:
             attachment_response: Dict[str, Any] = self._fetch_attachment(ctx, thread_id, message_id, attachment_id)
             self.api_fetching_ctx.process_attachment_for_message(
@@ -390,49 +435,47 @@ class GmailWrapper:
         descriptor.gmail_msg_body_part.body_data = attachment_response
 
     def parse_api_message(self, message: Dict):
-        message_part = GH.get_field(message, MessageField.PAYLOAD)
-        message_id: str = GH.get_field(message, MessageField.ID)
+        message_part = GH.get_field_value(message, F_MSG_PAYLOAD)
+        message_id: str = GH.get_field_value(message, F_MSG_ID)
         message_part_obj: MessagePart = self.parse_message_part(message_part, message_id)
         return Message(
             message_id,
-            GH.get_field(message, MessageField.THREAD_ID),
-            datetime.datetime.fromtimestamp(int(GH.get_field(message, MessageField.DATE)) / 1000),
-            GH.get_field(message, MessageField.SNIPPET),
+            GH.get_field_value(message, F_MSG_THREAD_ID),
+            datetime.datetime.fromtimestamp(int(GH.get_field_value(message, F_MSG_DATE)) / 1000),
+            GH.get_field_value(message, F_MSG_SNIPPET),
             message_part_obj,
         )
 
     def parse_message_part(self, message_part, message_id: str) -> MessagePart:
-        message_parts = GH.get_field(message_part, MessagePartField.PARTS, [])
-        headers = self._parse_headers(message_part)
+        message_parts = GH.get_field_value(message_part, F_PART_PARTS, [])
+        header_names, header_values = self._parse_headers(message_part)
         message_part_obj: MessagePart = MessagePart(
-            GH.get_field(message_part, MessagePartField.PART_ID),
-            GH.get_field(message_part, MessagePartField.MIME_TYPE),
-            headers,
-            self._parse_message_part_body_obj(GH.get_field(message_part, MessagePartField.BODY)),
+            GH.get_field_value(message_part, F_PART_ID),
+            GH.get_field_value(message_part, F_PART_MIME_TYPE),
+            header_names,
+            header_values,
+            self._parse_message_part_body_obj(GH.get_field_value(message_part, F_PART_BODY)),
             [self.parse_message_part(part, message_id) for part in message_parts],
         )
         return message_part_obj
 
     @staticmethod
-    def _parse_headers(message_part):
-        headers_list: List[Dict[str, str]] = GH.get_field(message_part, MessagePartField.HEADERS)
-        headers: List[Header] = []
+    def _parse_headers(message_part) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        headers_list: List[Dict[str, str]] = GH.get_field_value(message_part, F_PART_HEADERS)
         if not headers_list:
             LOG.warning("Headers is empty for message part: %s", message_part)
-            return headers
+            return (), ()
 
-        for header_dict in headers_list:
-            headers.append(
-                Header(GH.get_field(header_dict, HeaderField.NAME), GH.get_field(header_dict, HeaderField.VALUE))
-            )
-        return headers
+        header_names = tuple(GH.get_field_value(header_dict, F_HEADER_NAME) for header_dict in headers_list)
+        header_values = tuple(GH.get_field_value(header_dict, F_HEADER_VALUE) for header_dict in headers_list)
+        return header_names, header_values
 
     @staticmethod
     def _parse_message_part_body_obj(messagepart_body: Dict[str, Any]):
         message_part_body_obj = MessagePartBody(
-            GH.get_field(messagepart_body, MessagePartBodyField.DATA),
-            GH.get_field(messagepart_body, MessagePartBodyField.SIZE),
-            GH.get_field(messagepart_body, MessagePartBodyField.ATTACHMENT_ID),
+            GH.get_field_value(messagepart_body, F_BODY_DATA),
+            GH.get_field_value(messagepart_body, F_BODY_SIZE),
+            GH.get_field_value(messagepart_body, F_BODY_ATTACHMENT_ID),
         )
         return message_part_body_obj
 
@@ -487,7 +530,7 @@ class GmailWrapper:
             rt = GmailRequestType.THREADS_LIST
             list_of_threads: List[Dict[str, str]] = response.get(ThreadsResponseField.THREADS.value, [])
             progress.register_new_items(rt, len(list_of_threads), print_status=True)
-            thread_ids: List[str] = [GH.get_field(t, ThreadField.ID) for t in list_of_threads]
+            thread_ids: List[str] = [GH.get_field_value(t, F_THREAD_ID) for t in list_of_threads]
             self._process_threads(ctx, rt, thread_ids)
 
     def _process_threads(self, ctx: ApiConversionContext, rt: GmailRequestType, thread_ids: List[str]):
@@ -497,18 +540,23 @@ class GmailWrapper:
             thread_ids, ctx.expect_one_message_per_thread
         )
         self._log_cache_state_details(cache_state, thread_ids)
-        for idx, thread_id in enumerate(thread_ids):
-            # TODO consider limiting only real sent requests, not processed items!
-            progress.incr_processed_items(rt, thread_id)
-            if progress.is_limit_reached(rt):
-                LOG.warning(f"Reached request limit of {progress.limit}, stop processing more items.")
-                return ThreadQueryResults(ctx.threads)
-            progress.print_processing_items(rt)
-            thread_resp_full, loaded_from_cache = self._request_thread_or_load_from_cache(thread_id, cache_state, ctx)
-            if not loaded_from_cache:
-                self.api_fetching_ctx.process_thread(thread_resp_full)
-            thread_obj: Thread = self._convert_to_thread_object(ctx, ctx.sanity_check, thread_id, thread_resp_full)
-            ctx.threads.add(thread_obj)  # This action will internally create GmailMessage and rest of the stuff
-            ctx.handle_empty_bodies(lambda desc: self.request_attachment_or_load_from_cache(desc, ctx))
-
+        try:
+            for idx, thread_id in enumerate(thread_ids):
+                # TODO consider limiting only real sent requests, not processed items!
+                progress.incr_processed_items(rt, thread_id)
+                if progress.is_limit_reached(rt):
+                    LOG.warning(f"Reached request limit of {progress.limit}, stop processing more items.")
+                    return ThreadQueryResults(ctx.threads)
+                progress.print_processing_items(rt)
+                thread_resp_full, loaded_from_cache = self._request_thread_or_load_from_cache(
+                    thread_id, cache_state, ctx
+                )
+                if not loaded_from_cache:
+                    self.api_fetching_ctx.process_thread(thread_resp_full)
+                thread_obj: Thread = self._convert_to_thread_object(ctx, ctx.sanity_check, thread_id, thread_resp_full)
+                ctx.threads.add(thread_obj)  # This action will internally create GmailMessage and rest of the stuff
+                ctx.handle_empty_bodies(lambda desc: self.request_attachment_or_load_from_cache(desc, ctx))
+        finally:
+            # Also write what was fetched so far if processing failed, so it is not requested again
+            self.api_fetching_ctx.flush_cache()
         self.api_fetching_ctx.print_cache_actions()
@@ -7,9 +7,14 @@ LOG = logging.getLogger(__name__)
 
 
 class ApiFetchingContext:
-    def __init__(self, strategy: CachingStrategy) -> None:
+    __slots__ = ("_caching_strategy", "_warm_cache")
+
+    def __init__(self, strategy: CachingStrategy, warm_cache: bool = True) -> None:
         # TODO log debug cache strategy type
         self._caching_strategy = strategy
+        self._warm_cache = warm_cache
+        if warm_cache:
+            strategy.warm()
 
     @property
     def caching_strategy(self) -> "CachingStrategy":
@@ -17,6 +22,8 @@ class ApiFetchingContext:
 
     @caching_strategy.setter
     def caching_strategy(self, strategy: CachingStrategy) -> None:
+        if self._warm_cache:
+            strategy.warm()
         self._caching_strategy = strategy
 
     def process_thread(self, thread_response: Dict[str, Any]):
@@ -39,5 +46,8 @@ class ApiFetchingContext:
     def get_cached_threads(self) -> List[str]:
         return self._caching_strategy.get_cached_threads()
 
+    def flush_cache(self):
+        self._caching_strategy.flush()
+
     def print_cache_actions(self):
         self._caching_strategy.print_actions_performed()
@@ -1,66 +1,98 @@
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from enum import Enum
-from typing import Any, Dict, List, Iterable, Set, Tuple
+from enum import Enum, IntEnum
+from functools import lru_cache
+from typing import Any, Callable, Dict, FrozenSet, List, Iterable, Set, Tuple
 
-from pythoncommons.file_utils import FileUtils, FindResultType, JsonFileUtils
+from pythoncommons.file_utils import FileUtils
 from pythoncommons.string_utils import auto_str, StringUtils
 
 from googleapiwrapper.gmail_common import GmailRequestType
 from googleapiwrapper.gmail_common import (
     THREADS_DIR_NAME,
     MESSAGE_DATA_FILENAME,
+    MESSAGE_INDEX_DB_FILENAME,
     MESSAGE_ID,
     MESSAGE_DATE,
     THREAD_JSON_FILENAME,
     MESSAGES_DIR_NAME,
 )
-from googleapiwrapper.gmail_domain import GenericObjectHelper as GH, ThreadField, MessageField
-from googleapiwrapper.utils import CommonUtils
+from googleapiwrapper.gmail_domain import (
+    GenericObjectHelper as GH,
+    F_MSG_DATE,
+    F_MSG_ID,
+    F_THREAD_ID,
+    F_THREAD_MESSAGES,
+)
+from googleapiwrapper.utils import CommonUtils, DATACLASS_SLOTS
 
 import logging
 
 LOG = logging.getLogger(__name__)
+# Level of LOG.trace, as registered by pythoncommons' SimpleLoggingSetup
+TRACE_LEVEL = logging.DEBUG - 5
+
+# Cache files are only read back by this module, so they are written compact unless explicitly requested for debugging
+PRETTY_PRINT_CACHE_FILES = os.environ.get("GAW_DEBUG_JSON") == "1"
+
+
+@lru_cache(maxsize=4096)
+def _get_attachment_filename(message_id: str, attachment_id: str) -> str:
+    # The same filename is needed both when checking the cache state and when writing the attachment
+    return f"message_{message_id}_attachment_{StringUtils.md5_hash(attachment_id)}.txt"
+
 
+class ItemCacheState(IntEnum):
+    # Values index the per-state item collections of CacheResultItems
+    NOT_CACHED = 0
+    CACHE_LEVEL_NOT_DETERMINED = 1
+    FULLY_CACHED = 2
+    PARTIALLY_CACHED = 3
 
-class ItemCacheState(Enum):
-    NOT_CACHED = "not cached"
-    CACHE_LEVEL_NOT_DETERMINED = "cache level not yet determined"
-    FULLY_CACHED = "fully cached"
-    PARTIALLY_CACHED = "partially cached"
+    @property
+    def label(self) -> str:
+        return _STATE_LABELS[self]
 
 
-@dataclass
-class CachedItem:
-    id: str
-    data: Any = field(repr=False)
-    cache_state: ItemCacheState
+# Human-readable state names, also used as status dict keys.
+# Interned as they are not identifiers so the compiler won't intern them.
+_STATE_LABELS = (
+    sys.intern("not cached"),
+    sys.intern("cache level not yet determined"),
+    sys.intern("fully cached"),
+    sys.intern("partially cached"),
+)
+_FULLY_CACHED_KEY = _STATE_LABELS[ItemCacheState.FULLY_CACHED]
+_PARTIALLY_CACHED_KEY = _STATE_LABELS[ItemCacheState.PARTIALLY_CACHED]
+_NOT_CACHED_KEY = _STATE_LABELS[ItemCacheState.NOT_CACHED]
+_NOT_DETERMINED_KEY = _STATE_LABELS[ItemCacheState.CACHE_LEVEL_NOT_DETERMINED]
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class CacheMeta:
     type: str
     type_plural: str
+    type_capitalized: str = field(init=False, repr=False)
 
     def __post_init__(self):
         self.type_capitalized = self.type.title()
 
 
-@dataclass
+@dataclass(frozen=True, **DATACLASS_SLOTS)
 class CacheMetrics:
     items_written: int
     bytes_written: int
     items_read: int
     bytes_read: int
 
-    def _combine(self, other):
-        items_written = self.items_written + other.items_written
-        bytes_written = self.bytes_written + other.bytes_written
-        items_read = self.items_read + other.items_read
-        bytes_read = self.bytes_read + other.bytes_read
-        return CacheMetrics(items_written, bytes_written, items_read, bytes_read)
-
     @staticmethod
     def create_for_read(items_read, bytes_read):
         return CacheMetrics(0, 0, items_read, bytes_read)
@@ -77,47 +109,60 @@ class CacheMetrics:
     def combine(*actions):
         if not actions:
             raise ValueError("Expected at least one instance of " + CacheMetrics.__class__.__name__)
-        result = actions[0]
-        for i in range(1, len(actions)):
-            result = result._combine(actions[i])
-        return result
+        # Sum all fields in a single pass and create only one result instance
+        items_written = bytes_written = items_read = bytes_read = 0
+        for action in actions:
+            items_written += action.items_written
+            bytes_written += action.bytes_written
+            items_read += action.items_read
+            bytes_read += action.bytes_read
+        return CacheMetrics(items_written, bytes_written, items_read, bytes_read)
 
     def __str__(self):
         return (
-            self.__class__.__name__
-            + " { "
-            + "items written: "
-            + str(self.items_written)
-            + ", bytes written (dynamic): "
-            + StringUtils.format_bytes_as_str(self.bytes_written)
-            + ", items read: "
-            + str(self.items_read)
-            + ", bytes read (dynamic): "
-            + StringUtils.format_bytes_as_str(self.bytes_read)
-            + " }"
+            f"{self.__class__.__name__} {{ "
+            f"items written: {self.items_written}, "
+            f"bytes written (dynamic): {StringUtils.format_bytes_as_str(self.bytes_written)}, "
+            f"items read: {self.items_read}, "
+            f"bytes read (dynamic): {StringUtils.format_bytes_as_str(self.bytes_read)} }}"
         )
 
 
 class CacheActionsPerformed:
     def __init__(self):
-        self._latest: Dict["GmailRequestType", CacheMetrics] = defaultdict(CacheMetrics.create_empty)
-        self._sum: Dict["GmailRequestType", CacheMetrics] = defaultdict(CacheMetrics.create_empty)
+        self._latest: Dict["GmailRequestType", CacheMetrics] = {}
+        self._sum: Dict["GmailRequestType", CacheMetrics] = {}
 
     def add(self, request_type: "GmailRequestType", metrics: CacheMetrics):
         self._latest[request_type] = metrics
-        self._sum[request_type] = self._sum[request_type].combine(metrics)
+        # Metrics are immutable, so the first instance of a request type can be stored as its sum
+        prev_sum = self._sum.get(request_type)
+        self._sum[request_type] = metrics if prev_sum is None else CacheMetrics.combine(prev_sum, metrics)
         self.log(request_type)
 
     def log(self, request_type):
+        # Called on every add, skip formatting unless trace logging is on.
+        # Only the sum of the updated request type changed, use print_all to log all of them.
+        if not LOG.isEnabledFor(TRACE_LEVEL):
+            return
         LOG.trace("Added metrics for %s: %s", request_type, self._latest[request_type])
-        for req_type, metrics in self._sum.items():
-            LOG.trace("Sum metrics for %s: %s", req_type, metrics)
+        LOG.trace("Sum metrics for %s: %s", request_type, self._sum[request_type])
 
     def print_all(self):
         for req_type, metrics in self._sum.items():
             LOG.info("Sum metrics for %s: %s", req_type, metrics)
 
 
+# Shared, read-only stand-in for per-state item dicts that were not created yet
+_EMPTY_ITEMS: Dict[str, None] = {}
+
+
+class _ItemData(dict):
+    # Item data can be whole threads or attachments, only show the number of items when CacheResultItems is logged
+    def __repr__(self):
+        return f"<data of {len(self)} items>"
+
+
 @auto_str
 class CacheResultItems:
     def __init__(self, item_ids: List[str], cache_type: str, cache_type_plural: str = None):
@@ -125,28 +170,69 @@ class CacheResultItems:
             cache_type_plural = f"{cache_type}s"
         self._meta = CacheMeta(cache_type, cache_type_plural)
         self.item_ids = item_ids
-        self.not_cached_items: Dict[str, CachedItem] = {}
-        self.partially_cached_items: Dict[str, CachedItem] = {}
-        self.not_yet_determined_items: Dict[str, CachedItem] = {}
-        self.fully_cached_items: Dict[str, CachedItem] = {}
+        self._item_ids_set: FrozenSet[str] = frozenset(item_ids)
+        # Indexed by cache state, holds the IDs of items in that state as dict keys, preserving insertion order.
+        # Per-state dicts are only created when an item is added.
+        self._items: List[Dict[str, None] or None] = [None] * len(ItemCacheState)
+        # Data of fully cached items is kept apart, so the state collections only ever hold IDs
+        self._data: Dict[str, Any] = _ItemData()
+        self._data_loader: Callable[[str], Any] or None = None
 
     def add_not_cached(self, item_ids: Iterable[str]):
-        self.not_cached_items.update(self._create_list(item_ids, ItemCacheState.NOT_CACHED))
+        self._add_ids(ItemCacheState.NOT_CACHED, item_ids)
         return self
 
     def add_partially_cached(self, item_ids: Iterable[str]):
-        self.partially_cached_items.update(self._create_list(item_ids, ItemCacheState.PARTIALLY_CACHED))
+        self._add_ids(ItemCacheState.PARTIALLY_CACHED, item_ids)
         return self
 
     def add_not_yet_determined(self, item_ids: Iterable[str]):
-        self.not_yet_determined_items.update(self._create_list(item_ids, ItemCacheState.CACHE_LEVEL_NOT_DETERMINED))
+        self._add_ids(ItemCacheState.CACHE_LEVEL_NOT_DETERMINED, item_ids)
         return self
 
     def add_fully_cached(self, item_ids_with_data: Dict[str, Any]):
-        for item_id, data in item_ids_with_data.items():
-            self.fully_cached_items[item_id] = CachedItem(item_id, data, ItemCacheState.FULLY_CACHED)
+        if item_ids_with_data:
+            self._add_ids(ItemCacheState.FULLY_CACHED, item_ids_with_data)
+            self._data.update(item_ids_with_data)
+        return self
+
+    def add_fully_cached_lazy(self, item_ids: Iterable[str], data_loader: Callable[[str], Any]):
+        """
+        Adds fully cached items without their data. The data is loaded with data_loader on first access.
+        """
+        self._data_loader = data_loader
+        self._add_ids(ItemCacheState.FULLY_CACHED, item_ids)
         return self
 
+    def _add_ids(self, state: ItemCacheState, item_ids: Iterable[str]):
+        items = self._items[state]
+        if items is None:
+            self._items[state] = dict.fromkeys(item_ids)
+        else:
+            items.update(dict.fromkeys(item_ids))
+
+    def _get_items_for_update(self, state: ItemCacheState) -> Dict[str, None]:
+        items = self._items[state]
+        if items is None:
+            items = self._items[state] = {}
+        return items
+
+    @property
+    def not_cached_items(self) -> Dict[str, None]:
+        return self._items[ItemCacheState.NOT_CACHED] or _EMPTY_ITEMS
+
+    @property
+    def partially_cached_items(self) -> Dict[str, None]:
+        return self._items[ItemCacheState.PARTIALLY_CACHED] or _EMPTY_ITEMS
+
+    @property
+    def not_yet_determined_items(self) -> Dict[str, None]:
+        return self._items[ItemCacheState.CACHE_LEVEL_NOT_DETERMINED] or _EMPTY_ITEMS
+
+    @property
+    def fully_cached_items(self) -> Dict[str, None]:
+        return self._items[ItemCacheState.FULLY_CACHED] or _EMPTY_ITEMS
+
     @property
     def not_cached_ids(self):
         return self.not_cached_items.keys()
@@ -163,18 +249,14 @@ class CacheResultItems:
     def fully_cached_ids(self):
         return self.fully_cached_items.keys()
 
-    @staticmethod
-    def _create_list(item_ids: Iterable[str], state: ItemCacheState) -> Dict[str, CachedItem]:
-        return {id: CachedItem(id, None, state) for id in item_ids}
-
     def are_all_fully_cached(self) -> bool:
-        return sum([len(self.not_cached_ids), len(self.partially_cached_ids), len(self.not_yet_determined_ids)]) == 0
+        return not (self.not_cached_items or self.partially_cached_items or self.not_yet_determined_items)
 
     def get_no_of_any_cached_all(self) -> int:
         """
         :return: Any cached item. This also counts all cached items not related to the specified item_ids during init.
         """
-        return sum([len(self.fully_cached_ids), len(self.partially_cached_ids), len(self.not_yet_determined_ids)])
+        return len(self.fully_cached_items) + len(self.partially_cached_items) + len(self.not_yet_determined_items)
 
     def get_no_of_any_cached_for_items(self) -> int:
         """
@@ -182,9 +264,9 @@ class CacheResultItems:
         """
         return sum(
             [
-                len(set(self.fully_cached_ids).intersection(self.item_ids)),
-                len(set(self.partially_cached_items).intersection(self.item_ids)),
-                len(set(self.not_yet_determined_ids).intersection(self.item_ids)),
+                len(self.fully_cached_ids & self._item_ids_set),
+                len(self.partially_cached_ids & self._item_ids_set),
+                len(self.not_yet_determined_ids & self._item_ids_set),
             ]
         )
 
@@ -194,44 +276,42 @@ class CacheResultItems:
     def get_data_for_item(self, item_id: str):
         if item_id not in self.fully_cached_items:
             raise ValueError(f"Can't get data from a non-fully cached item. Item ID: {item_id}")
-        return self.fully_cached_items[item_id].data
+        data = self._data.get(item_id)
+        if data is None and self._data_loader:
+            data = self._data[item_id] = self._data_loader(item_id)
+        return data
 
     def get_status_dict(self, ids=False, lengths=True):
-        def _dict_val(coll):
-            if ids:
-                return coll
-            elif lengths:
-                return len(coll)
-            return self.not_yet_determined_ids if ids else len(self.not_yet_determined_ids)
-
+        if ids:
+            return {
+                _FULLY_CACHED_KEY: self.fully_cached_ids,
+                _PARTIALLY_CACHED_KEY: self.partially_cached_ids,
+                _NOT_CACHED_KEY: self.not_cached_ids,
+                _NOT_DETERMINED_KEY: self.not_yet_determined_ids,
+            }
+        # Lengths are returned by default, the lengths flag is kept for backward compatibility
         return {
-            ItemCacheState.FULLY_CACHED.value: _dict_val(self.fully_cached_ids),
-            ItemCacheState.PARTIALLY_CACHED.value: _dict_val(self.partially_cached_ids),
-            ItemCacheState.NOT_CACHED.value: _dict_val(self.not_cached_ids),
-            ItemCacheState.CACHE_LEVEL_NOT_DETERMINED.value: _dict_val(self.not_yet_determined_ids),
+            _FULLY_CACHED_KEY: len(self.fully_cached_items),
+            _PARTIALLY_CACHED_KEY: len(self.partially_cached_items),
+            _NOT_CACHED_KEY: len(self.not_cached_items),
+            _NOT_DETERMINED_KEY: len(self.not_yet_determined_items),
         }
 
     def mark_partially_cached(self, item_id):
         item_state: ItemCacheState = self._get_item_cache_status(item_id)
-        self.partially_cached_items[item_id] = CachedItem(item_id, None, ItemCacheState.PARTIALLY_CACHED)
+        self._get_items_for_update(ItemCacheState.PARTIALLY_CACHED)[item_id] = None
         self._remove_from_previous_collection(item_id, item_state)
 
     def mark_fully_cached(self, item_id, item_data):
         item_state: ItemCacheState = self._get_item_cache_status(item_id)
-        self.fully_cached_items[item_id] = CachedItem(item_id, item_data, ItemCacheState.FULLY_CACHED)
+        self._get_items_for_update(ItemCacheState.FULLY_CACHED)[item_id] = None
+        self._data[item_id] = item_data
         self._remove_from_previous_collection(item_id, item_state)
 
     def _get_item_cache_status(self, item_id):
-        not_yet_determined = True if item_id in self.not_yet_determined_ids else False
-        not_cached = True if item_id in self.not_cached_ids else False
-
-        if not any([not_cached, not_yet_determined]):
-            raise ValueError(
-                f"{self._meta.type_capitalized} with ID '{item_id}' should be in the collection of {self._meta.type_plural} "
-                f"with not yet determined or not cached state but it wasn't in any of these. "
-                f"This could be a programming error!"
-            )
-        if all([not_cached, not_yet_determined]):
+        not_cached = item_id in self.not_cached_items
+        # Sanity check of an invariant, skipped when running with -O
+        if __debug__ and not_cached and item_id in self.not_yet_determined_items:
             raise ValueError(
                 f"{self._meta.type_capitalized} with ID '{item_id}' is in the collection of {self._meta.type_plural} "
                 f"with not yet determined AND not cached state but should be only one of these. "
@@ -239,14 +319,17 @@ class CacheResultItems:
             )
         if not_cached:
             return ItemCacheState.NOT_CACHED
-        else:
+        if item_id in self.not_yet_determined_items:
             return ItemCacheState.CACHE_LEVEL_NOT_DETERMINED
+        raise ValueError(
+            f"{self._meta.type_capitalized} with ID '{item_id}' should be in the collection of {self._meta.type_plural} "
+            f"with not yet determined or not cached state but it wasn't in any of these. "
+            f"This could be a programming error!"
+        )
 
     def _remove_from_previous_collection(self, item_id, item_state):
-        if item_state == ItemCacheState.NOT_CACHED:
-            del self.not_cached_items[item_id]
-        elif item_state == ItemCacheState.CACHE_LEVEL_NOT_DETERMINED:
-            del self.not_yet_determined_items[item_id]
+        # _get_item_cache_status only returns states whose collection holds the item
+        del self._items[item_state][item_id]
 
     @property
     def cache_type(self):
@@ -279,7 +362,16 @@ class CachingStrategy(ABC):
         self.output_basedir = output_basedir
         self.project_name = project_name
         self.user_email = user_email
-        self.fill_cache()
+        self._warmed = False
+
+    def warm(self):
+        """
+        Fills the cache if it was not filled yet.
+        Kept separate from construction so that creating a strategy does not load the cache.
+        """
+        if not self._warmed:
+            self.fill_cache()
+            self._warmed = True
 
     @abstractmethod
     def fill_cache(self):
@@ -315,16 +407,40 @@ class CachingStrategy(ABC):
     def print_actions_performed(self):
         pass
 
+    @abstractmethod
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 class FileSystemEmailThreadCacheStrategy(CachingStrategy):
+    WRITE_BATCH_SIZE = 64
+    WRITE_FLUSH_INTERVAL_SECONDS = 5.0
+    THREAD_DATA_CACHE_SIZE = 1024
+    # Stored as the user_version of the message index once the legacy message data files are imported
+    MESSAGE_INDEX_LEGACY_IMPORTED_VERSION = 1
+    # Message data loaded by fill_cache, shared by strategies using the same message index.
+    # Key: index DB path, value: (signature of the index contents, cached thread IDs). Least recently used are evicted.
+    _FILL_CACHE_MEMO: "OrderedDict[str, Tuple[Tuple, Set[str]]]" = OrderedDict()
+    FILL_CACHE_MEMO_SIZE = 8
+
     def __init__(self, output_basedir: str, project_name: str, user_email: str):
         # Cache-related properties
-        self.cached_thread_ids: List[str] = []
-        # Key: Message ID
-        self.cached_message_attachments: Set[Tuple[str, str, str]] = set()  # Tuple: (threadID, messageID, attachmentID)
-        # Main key: Thread id
-        # Inner-dict key: message id, value: message date
-        self.thread_to_message_data: Dict[str, Dict[str, str]] = {}
+        # Key: Thread ID, value: Filenames of cached message attachments of the thread.
+        # Filled from a single listing of the thread's messages dir when the thread is first queried.
+        self.cached_message_attachments: Dict[str, Set[str]] = {}
+        # Key: Thread id, holds all cached threads. Value: IDs of the cached messages of the thread.
+        # Message dates are only kept in the message index, as they are not needed for determining the cache state.
+        # The value is None until the message IDs of the thread are needed, see _get_message_ids_for_thread
+        self.thread_to_message_ids: Dict[str, FrozenSet[str] or None] = {}
         self.unknown_message_per_thread: Dict[str, Set[str]] = {}
 
         # Other properties
@@ -333,100 +449,342 @@ class FileSystemEmailThreadCacheStrategy(CachingStrategy):
         self.threads_dir = FileUtils.ensure_dir_created(
             FileUtils.join_path(self.project_acct_basedir, THREADS_DIR_NAME)
         )
+        # Only the thread ID varies in per-thread paths, so concatenate to this prefix instead of re-joining paths
+        self._threads_dir_prefix = self.threads_dir + os.sep
         self._cache_actions_performed = CacheActionsPerformed()
+        # Writes are buffered and flushed in batches. Key: file path, value: (data, request type of the write)
+        self._dirty: Dict[str, Tuple[Any, GmailRequestType]] = {}
+        self._last_flush = time.monotonic()
+        # Batches are written by a single background thread, so the fetch loop does not wait for the disk.
+        # Writes that are submitted but not yet finished stay readable from _in_flight.
+        self._writer: ThreadPoolExecutor or None = None
+        self._writer_conn: sqlite3.Connection or None = None
+        self._in_flight: Dict[str, Tuple[Any, GmailRequestType]] = {}
+        self._submitted_batches: List[
+            Tuple[Future, Dict[str, Tuple[Any, GmailRequestType]], List[Tuple[str, str, str]]]
+        ] = []
+        # Message data of all threads is stored in a single index. Rows: (thread ID, message ID, message date)
+        self._message_index_db = FileUtils.join_path(self.project_acct_basedir, MESSAGE_INDEX_DB_FILENAME)
+        self._conn = self._connect_message_index()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS msg(thread_id TEXT, message_id TEXT PRIMARY KEY, message_date TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS msg_thread_id ON msg(thread_id)")
+        self._pending_index_rows: List[Tuple[str, str, str]] = []
+        # Key: thread ID, value: messages dir of the thread. Only holds threads whose dir was verified to exist.
+        self._messages_dirs: Dict[str, str] = {}
+        self._created_dirs: Set[str] = set()
+        # LRU of parsed thread JSONs. Key: thread ID, value: thread data
+        self._thread_data_cache: "OrderedDict[str, Any]" = OrderedDict()
+        # Pending writes are flushed at exit, unless the strategy is closed before.
+        # The registration keeps the strategy alive until then, so buffered writes are never dropped.
+        atexit.register(self.close)
         super().__init__(output_basedir, project_name, user_email)
 
+    @property
+    def cached_thread_ids(self):
+        return self.thread_to_message_ids.keys()
+
     def get_cached_threads(self):
-        return self.thread_to_message_data.keys()
+        return list(self.thread_to_message_ids)
 
     def fill_cache(self):
-        found_thread_dirnames: List[str] = FileUtils.find_files(
-            self.threads_dir, find_type=FindResultType.DIRS, regex=".*", single_level=True
+        (index_version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        if index_version < self.MESSAGE_INDEX_LEGACY_IMPORTED_VERSION:
+            self._import_legacy_message_data_files()
+
+        signature = self._get_index_signature()
+        memo = self._FILL_CACHE_MEMO.get(self._message_index_db)
+        if memo and memo[0] == signature:
+            self._FILL_CACHE_MEMO.move_to_end(self._message_index_db)
+            # The index did not change since it was last loaded, copy so the instances can diverge independently
+            LOG.debug("Message index did not change, reusing thread IDs loaded earlier")
+            self.thread_to_message_ids.update(dict.fromkeys(memo[1]))
+            return
+
+        # Only thread IDs are loaded eagerly, message data is loaded per thread once it is needed.
+        # IDs are interned as the same IDs are used as keys in multiple collections and compared a lot.
+        for (thread_id,) in self._conn.execute("SELECT DISTINCT thread_id FROM msg"):
+            self.thread_to_message_ids.setdefault(sys.intern(thread_id), None)
+        self._cache_actions_performed.add(
+            GmailRequestType.MESSAGES, CacheMetrics.create_for_read(len(self.thread_to_message_ids), 0)
         )
-        self.cached_thread_ids.extend(found_thread_dirnames)
-        for thread_id in self.cached_thread_ids:
-            metrics = self._load_message_data_from_file(thread_id)
-            self._cache_actions_performed.add(GmailRequestType.MESSAGES, metrics)
+        self._FILL_CACHE_MEMO[self._message_index_db] = (signature, set(self.thread_to_message_ids))
+        self._FILL_CACHE_MEMO.move_to_end(self._message_index_db)
+        while len(self._FILL_CACHE_MEMO) > self.FILL_CACHE_MEMO_SIZE:
+            self._FILL_CACHE_MEMO.popitem(last=False)
+
+        LOG.trace(f"Loaded cached thread IDs: {self.cached_thread_ids}")
+
+    def _get_message_ids_for_thread(self, thread_id: str) -> FrozenSet[str]:
+        if thread_id not in self.thread_to_message_ids:
+            return frozenset()
+        message_ids = self.thread_to_message_ids[thread_id]
+        if message_ids is not None:
+            return message_ids
+        message_ids = frozenset(
+            sys.intern(message_id)
+            for (message_id,) in self._conn.execute("SELECT message_id FROM msg WHERE thread_id = ?", (thread_id,))
+        )
+        self._cache_actions_performed.add(GmailRequestType.MESSAGES, CacheMetrics.create_for_read(len(message_ids), 0))
+        self.thread_to_message_ids[thread_id] = message_ids
+        return message_ids
 
-        LOG.trace(f"Loaded message data: {self.thread_to_message_data}")
+    def _get_index_signature(self) -> Tuple:
+        # Rows are only inserted, or replaced with the data of the same message, which gives them a new rowid.
+        # Unlike file timestamps, this can't miss a change on filesystems with coarse timestamps.
+        return tuple(self._conn.execute("SELECT count(*), max(rowid) FROM msg").fetchone())
 
-    def _load_message_data_from_file(self, thread_id) -> CacheMetrics:
+    def _import_legacy_message_data_files(self):
         """
-        Load all message IDs for all threads but loading all payloads into memory would be costly
-        so they are skipped here
+        Caches written before the message index existed stored message data in a JSON file per thread.
+        Import these into the index once. The import is marked as done in the index itself,
+        so an interrupted import is retried on the next fill.
         Example message data: [{'message_date': '1620084692000', 'message_id': '1793492a16dc62b5'}]
         """
-        message_data_file = FileUtils.join_path(self.threads_dir, thread_id, MESSAGE_DATA_FILENAME)
-        list_of_message_data, metrics = self._load_data_from_file(message_data_file)
-        self.thread_to_message_data[thread_id] = {
-            msg_data[MESSAGE_ID]: msg_data[MESSAGE_DATE] for msg_data in list_of_message_data
-        }
-        return metrics
+        with os.scandir(self.threads_dir) as it:
+            found_thread_dirnames: List[str] = [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+        rows: List[Tuple[str, str, str]] = []
+        if found_thread_dirnames:
+            # Loading the files is I/O bound, so load them in parallel
+            with ThreadPoolExecutor(max_workers=min(32, len(found_thread_dirnames))) as executor:
+                for thread_rows, metrics in executor.map(self._load_legacy_message_data, found_thread_dirnames):
+                    rows.extend(thread_rows)
+                    self._cache_actions_performed.add(GmailRequestType.MESSAGES, metrics)
+        if rows:
+            LOG.info("Importing message data of %d threads into the message index", len(found_thread_dirnames))
+            self._conn.executemany("INSERT OR REPLACE INTO msg VALUES (?,?,?)", rows)
+        # PRAGMA values can't be bound as parameters
+        self._conn.execute(f"PRAGMA user_version = {self.MESSAGE_INDEX_LEGACY_IMPORTED_VERSION}")
+        self._conn.commit()
+
+    def _load_legacy_message_data(self, thread_id: str) -> Tuple[List[Tuple[str, str, str]], CacheMetrics]:
+        message_data_file = self._get_thread_dir_path(thread_id) + os.sep + MESSAGE_DATA_FILENAME
+        if not FileUtils.does_file_exist(message_data_file):
+            return [], CacheMetrics.create_empty()
+        try:
+            list_of_message_data, metrics = self._load_data_from_file(message_data_file)
+            rows = [(thread_id, msg_data[MESSAGE_ID], msg_data[MESSAGE_DATE]) for msg_data in list_of_message_data]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # A single corrupt file should not prevent importing the others, the thread is just refetched
+            LOG.warning("Skipping invalid message data file: %s. Error: %s", message_data_file, e)
+            return [], CacheMetrics.create_empty()
+        return rows, metrics
 
     def process_threads(self, thread_response: Dict[str, Any]):
         # TODO only write to file if required, i.e. thread is not fully cached. Also, make this configurable
-        thread_id: str = GH.get_field(thread_response, ThreadField.ID)
-        thread_dir, metrics_1 = self._write_thread_data_to_file(thread_id, thread_response)
-        metrics_2 = self._write_message_data_to_file(thread_dir, thread_response)
-        metrics = CacheMetrics.combine(metrics_1, metrics_2)
-        self._cache_actions_performed.add(GmailRequestType.THREADS_GET, metrics)
+        thread_id: str = sys.intern(GH.get_field_value(thread_response, F_THREAD_ID))
+        self._write_thread_data_to_file(thread_id, thread_response)
+        index_rows = self._convert_thread_response_to_index_rows(thread_id, thread_response)
+        self._pending_index_rows.extend(index_rows)
+        # Keep the in-memory view of the cache up-to-date with the thread that was just written
+        self._thread_data_cache.pop(thread_id, None)
+        self.thread_to_message_ids[thread_id] = frozenset(sys.intern(message_id) for _, message_id, _ in index_rows)
 
     def process_attachment_for_message(
         self, thread_id: str, message_id: str, attachment_id: str, attachment_response: Dict[str, Any]
     ):
-        msg_attachment_filename = self._get_attachment_filename(
-            thread_id, message_id, attachment_id, create_messages_dir=True
+        messages_dir: str = self._get_messages_dir(thread_id, create=True)
+        attachment_filename = self._get_message_attachment_filename(message_id, attachment_id)
+        self._get_cached_attachment_filenames(thread_id).add(attachment_filename)
+        self._queue_write(
+            messages_dir + os.sep + attachment_filename, attachment_response, GmailRequestType.ATTACHMENTS
         )
-        metrics = self._write_to_file(msg_attachment_filename, attachment_response)
-        self._cache_actions_performed.add(GmailRequestType.ATTACHMENTS, metrics)
-
-    def _write_thread_data_to_file(self, thread_id: str, thread_response) -> Tuple[str, CacheMetrics]:
-        current_thread_dir = FileUtils.ensure_dir_created(FileUtils.join_path(self.threads_dir, thread_id))
-        raw_thread_json_file = FileUtils.join_path(current_thread_dir, THREAD_JSON_FILENAME)
-        metrics = self._write_to_file(raw_thread_json_file, thread_response)
-        return current_thread_dir, metrics
-
-    def _write_message_data_to_file(self, thread_dir: str, thread_response) -> CacheMetrics:
-        message_data_dicts: List[Dict[str, str]] = self._convert_thread_response_to_message_data_dicts(thread_response)
-        message_data_file = FileUtils.join_path(thread_dir, MESSAGE_DATA_FILENAME)
-        return self._write_to_file(message_data_file, message_data_dicts)
 
-    @staticmethod
-    def _load_data_from_file(file) -> Tuple[List[Dict[str, str]], CacheMetrics]:
-        data, bytes_read = JsonFileUtils.load_data_from_json_file(file)
-        return data, CacheMetrics.create_for_read(1, bytes_read)
+    def _write_thread_data_to_file(self, thread_id: str, thread_response):
+        # The thread dir is created right away, only the file contents are written lazily
+        thread_dir = self._ensure_dir_created(self._get_thread_dir_path(thread_id))
+        raw_thread_json_file = thread_dir + os.sep + THREAD_JSON_FILENAME
+        self._queue_write(raw_thread_json_file, thread_response, GmailRequestType.THREADS_GET)
+
+    def _queue_write(self, file: str, data: Any, request_type: GmailRequestType):
+        self._dirty[file] = (data, request_type)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        self._collect_written_batches(wait=False)
+        if (
+            len(self._dirty) >= self.WRITE_BATCH_SIZE
+            or time.monotonic() - self._last_flush > self.WRITE_FLUSH_INTERVAL_SECONDS
+        ):
+            self._submit_batch()
+
+    def _submit_batch(self):
+        batch, index_rows = self._take_batch()
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gmail-cache-writer")
+        self._in_flight.update(batch)
+        future = self._writer.submit(self._write_batch, batch, index_rows)
+        self._submitted_batches.append((future, batch, index_rows))
+
+    def flush(self):
+        # Wait for the background writes, then write the rest on the calling thread.
+        # This also works from atexit, where the executor does not accept new work anymore.
+        # Failed background writes are requeued by _collect_written_batches, so they are retried here.
+        # If the retry fails as well, its error is raised.
+        self._collect_written_batches(wait=True)
+        batch, index_rows = self._take_batch()
+        try:
+            write_metrics = self._write_batch(batch, index_rows, conn=self._conn)
+        except Exception:
+            self._requeue_failed_batch(batch, index_rows)
+            raise
+        self._record_write_metrics(write_metrics)
+
+    def close(self):
+        """
+        Writes the pending cache data, stops the background writer and closes the message index.
+        The strategy can't be used after it is closed.
+        """
+        if self._conn is None:
+            return
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            if self._writer is not None:
+                self._writer.shutdown(wait=True)
+                self._writer = None
+            if self._writer_conn is not None:
+                self._writer_conn.close()
+                self._writer_conn = None
+            self._conn.close()
+            self._conn = None
+
+    def _take_batch(self) -> Tuple[Dict[str, Tuple[Any, GmailRequestType]], List[Tuple[str, str, str]]]:
+        batch, self._dirty = self._dirty, {}
+        index_rows, self._pending_index_rows = self._pending_index_rows, []
+        self._last_flush = time.monotonic()
+        return batch, index_rows
+
+    def _write_batch(
+        self,
+        batch: Dict[str, Tuple[Any, GmailRequestType]],
+        index_rows: List[Tuple[str, str, str]],
+        conn: sqlite3.Connection = None,
+    ) -> List[Tuple[GmailRequestType, CacheMetrics]]:
+        write_metrics: List[Tuple[GmailRequestType, CacheMetrics]] = []
+        for file, (data, request_type) in batch.items():
+            write_metrics.append((request_type, self._write_to_file(file, data)))
+        if index_rows:
+            if conn is None:
+                # Only the writer thread gets here, sqlite connections can't be shared between threads
+                if self._writer_conn is None:
+                    # Only used by the writer thread, but closed by close() after the writer is shut down
+                    self._writer_conn = self._connect_message_index()
+                conn = self._writer_conn
+            conn.executemany("INSERT OR REPLACE INTO msg VALUES (?,?,?)", index_rows)
+            conn.commit()
+            write_metrics.append((GmailRequestType.THREADS_GET, CacheMetrics.create_for_write(len(index_rows), 0)))
+        return write_metrics
+
+    def _collect_written_batches(self, wait: bool):
+        while self._submitted_batches and (wait or self._submitted_batches[0][0].done()):
+            future, batch, index_rows = self._submitted_batches.pop(0)
+            try:
+                write_metrics = future.result()
+            except Exception:
+                LOG.exception("Failed to write batch of %d cache files, will be retried", len(batch))
+                self._requeue_failed_batch(batch, index_rows)
+                continue
+            for file, entry in batch.items():
+                # A later write of the same file may be pending, only drop the entry if it's the one written
+                if self._in_flight.get(file) is entry:
+                    del self._in_flight[file]
+            self._record_write_metrics(write_metrics)
+
+    def _requeue_failed_batch(
+        self, batch: Dict[str, Tuple[Any, GmailRequestType]], index_rows: List[Tuple[str, str, str]]
+    ):
+        for file, entry in batch.items():
+            in_flight_entry = self._in_flight.get(file)
+            if in_flight_entry is entry:
+                del self._in_flight[file]
+            elif in_flight_entry is not None:
+                # A later write of the same file is already submitted
+                continue
+            # Never overwrite a later write of the same file with this older data
+            self._dirty.setdefault(file, entry)
+        # Keep the original order of the index rows, so later rows still replace these
+        self._pending_index_rows[:0] = index_rows
+
+    def _record_write_metrics(self, write_metrics: List[Tuple[GmailRequestType, CacheMetrics]]):
+        for request_type, metrics in write_metrics:
+            self._cache_actions_performed.add(request_type, metrics)
+
+    def _connect_message_index(self) -> sqlite3.Connection:
+        # A connection is never used by two threads at the same time, but not always by the thread that opened it:
+        # the writer connection is opened by a pool thread, and flush / close can run from atexit or another thread.
+        conn = sqlite3.connect(self._message_index_db, check_same_thread=False)
+        # WAL with synchronous=NORMAL only syncs on checkpoints, a lost tail of the index is just refetched
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _get_pending_write(self, file: str) -> Tuple[Any, GmailRequestType] or None:
+        entry = self._dirty.get(file)
+        if entry is None:
+            entry = self._in_flight.get(file)
+        return entry
+
+    def _does_file_exist(self, file: str) -> bool:
+        return self._get_pending_write(file) is not None or FileUtils.does_file_exist(file)
+
+    def _load_data_from_file(self, file) -> Tuple[Any, CacheMetrics]:
+        pending_write = self._get_pending_write(file)
+        if pending_write is not None:
+            # Not yet written to disk, serve it from memory
+            return pending_write[0], CacheMetrics.create_empty()
+        # Read the whole file with a single read and let the C decoder parse the bytes
+        with open(file, "rb") as f:
+            raw = f.read()
+        return json.loads(raw), CacheMetrics.create_for_read(1, len(raw))
 
     @staticmethod
     def _write_to_file(file, data) -> CacheMetrics:
-        bytes_written = JsonFileUtils.write_data_to_file_as_json(file, data, pretty=True)
-        return CacheMetrics.create_for_write(1, bytes_written)
+        if PRETTY_PRINT_CACHE_FILES:
+            raw = json.dumps(data, indent=4).encode()
+        else:
+            raw = json.dumps(data, separators=(",", ":")).encode()
+        # Write to a temp file and rename it so a partially written cache file is never visible
+        tmp_file = file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_file, file)
+        return CacheMetrics.create_for_write(1, len(raw))
 
     def get_cache_state_for_threads(self, thread_ids: List[str], expect_one_message_per_thread: bool):
-        unknown_thread_ids: Set[str] = set(thread_ids).difference(set(self.cached_thread_ids))
+        # Partition in a single pass, keeping the order of the requested thread IDs
+        cached_thread_ids = self.thread_to_message_ids
+        known_thread_ids: List[str] = []
+        unknown_thread_ids: List[str] = []
+        for t_id in thread_ids:
+            if t_id in cached_thread_ids:
+                known_thread_ids.append(t_id)
+            else:
+                unknown_thread_ids.append(t_id)
         if expect_one_message_per_thread:
             # Only query threads that are not in cache, on other words unknown.
-            # All known thread IDs are stored in self.thread_ids.
-            # When only one message / thread is expected, consider all known threads as fully cached.
-
-            fully_cached = {}
-            for t_id in self.cached_thread_ids:
-                try:
-                    fully_cached[t_id], metrics = self._get_thread_from_file_system(t_id)
-                    self._cache_actions_performed.add(GmailRequestType.THREADS_LIST, metrics)
-                except Exception as e:
-                    LOG.error("Error while processing thread.", e)
-                    LOG.warning("Cannot open file for thread: %s. Adding it to not cached threads.", t_id)
-                    unknown_thread_ids.add(t_id)
+            # All known thread IDs are stored as keys of self.thread_to_message_ids.
+            # When only one message / thread is expected, consider all requested known threads as fully cached.
+
+            # Thread data is only loaded from the file system once it is requested from the CacheResultItems.
+            fully_cached: List[str] = []
+            for t_id in known_thread_ids:
+                if self._does_file_exist(self._get_thread_json_path(t_id)):
+                    fully_cached.append(t_id)
+                else:
+                    LOG.warning("Cannot find file for thread: %s. Adding it to not cached threads.", t_id)
+                    unknown_thread_ids.append(t_id)
 
             return (
                 CacheResultItems(thread_ids, cache_type="thread")
                 .add_not_cached(unknown_thread_ids)
-                .add_fully_cached(fully_cached)
+                .add_fully_cached_lazy(fully_cached, self._load_thread_data)
             )
 
         # If we expect more than 1 message per thread, even known threads may have new messages.
         # In this case, treat all known thread IDs as not yet determined, as messages should be queried again for them.
-        known_thread_ids: Set[str] = set(thread_ids).difference(unknown_thread_ids)
         return (
             CacheResultItems(thread_ids, cache_type="thread")
             .add_not_yet_determined(known_thread_ids)
@@ -443,35 +801,41 @@ class FileSystemEmailThreadCacheStrategy(CachingStrategy):
         :param attachment_id:
         :return:
         """
-        attachment_data = None
-        cache_key = (thread_id, message_id, attachment_id)
-        if cache_key not in self.cached_message_attachments:
-            # Try to load from Filesystem
-            msg_attachment_filename = self._get_attachment_filename(
-                thread_id, message_id, attachment_id, create_messages_dir=False
-            )
-            if FileUtils.does_file_exist(msg_attachment_filename):
-                attachment_data = self._load_data_from_file(msg_attachment_filename)
-                self.cached_message_attachments.add(cache_key)
-
-        # if not attachment_data:
-        #     raise ValueError("BUG! Attachment data is not set!")
-        # TODO bug here, attachment_data is None --> Load from disk or memory?
-        cached = {thread_id: attachment_data} if cache_key in self.cached_message_attachments else {}
-        not_cached = [] if len(cached) > 0 else [thread_id]
+        cached: Dict[str, Any] = {}
+        attachment_filename = self._get_message_attachment_filename(message_id, attachment_id)
+        if attachment_filename in self._get_cached_attachment_filenames(thread_id):
+            messages_dir: str = self._get_messages_dir(thread_id, create=False)
+            attachment_data, metrics = self._load_data_from_file(messages_dir + os.sep + attachment_filename)
+            self._cache_actions_performed.add(GmailRequestType.ATTACHMENTS, metrics)
+            cached[message_id] = attachment_data
+
+        not_cached = [] if cached else [message_id]
         return (
             CacheResultItems([message_id], cache_type="message attachment")
             .add_not_cached(not_cached)
             .add_fully_cached(cached)
         )
 
-    def _get_attachment_filename(self, thread_id, message_id, attachment_id, create_messages_dir=True):
-        thread_dir = self._get_thread_dir(thread_id)
-        messages_dir: str = self._get_messages_dir(thread_dir, create=create_messages_dir)
-        return FileUtils.join_path(messages_dir, self._get_message_attachment_filename(message_id, attachment_id))
+    def _get_cached_attachment_filenames(self, thread_id: str) -> Set[str]:
+        filenames = self.cached_message_attachments.get(thread_id)
+        if filenames is None:
+            messages_dir: str = self._get_messages_dir(thread_id, create=False)
+            try:
+                with os.scandir(messages_dir) as it:
+                    filenames = {entry.name for entry in it}
+            except FileNotFoundError:
+                filenames = set()
+            self.cached_message_attachments[thread_id] = filenames
+        return filenames
+
+    def _get_thread_dir_path(self, thread_id: str) -> str:
+        return self._threads_dir_prefix + thread_id
+
+    def _get_thread_json_path(self, thread_id: str) -> str:
+        return self._threads_dir_prefix + thread_id + os.sep + THREAD_JSON_FILENAME
 
     def _get_thread_dir(self, thread_id):
-        thread_dir: str = FileUtils.join_path(self.threads_dir, thread_id)
+        thread_dir: str = self._get_thread_dir_path(thread_id)
         if not FileUtils.does_path_exist(thread_dir):
             raise ValueError(
                 f"Thread dir does not exist for thread with ID: {thread_dir}. "
@@ -479,13 +843,21 @@ class FileSystemEmailThreadCacheStrategy(CachingStrategy):
             )
         return thread_dir
 
-    @staticmethod
-    def _get_messages_dir(thread_dir, create=True):
-        messages_dir = FileUtils.join_path(thread_dir, MESSAGES_DIR_NAME)
+    def _get_messages_dir(self, thread_id, create=True):
+        messages_dir = self._messages_dirs.get(thread_id)
+        if messages_dir is None:
+            messages_dir = self._get_thread_dir(thread_id) + os.sep + MESSAGES_DIR_NAME
+            self._messages_dirs[thread_id] = messages_dir
         if create:
-            FileUtils.ensure_dir_created(messages_dir)
+            self._ensure_dir_created(messages_dir)
         return messages_dir
 
+    def _ensure_dir_created(self, dir_path: str):
+        if dir_path not in self._created_dirs:
+            FileUtils.ensure_dir_created(dir_path)
+            self._created_dirs.add(dir_path)
+        return dir_path
+
     def _get_thread_from_file_system(self, thread_id: str) -> Tuple[Any, CacheMetrics]:
         """
         Caution: This loads all thread data into memory including message payloads.
@@ -493,38 +865,56 @@ class FileSystemEmailThreadCacheStrategy(CachingStrategy):
         :param thread_id:
         :return:
         """
-        if thread_id not in self.cached_thread_ids:
+        if thread_id not in self.thread_to_message_ids:
             raise ValueError(f"Thread with ID '{thread_id}' is not in cache. This should not happen at this point.")
-        thread_json_file = FileUtils.join_path(self.threads_dir, thread_id, THREAD_JSON_FILENAME)
-        return self._load_data_from_file(thread_json_file)
+        if thread_id in self._thread_data_cache:
+            self._thread_data_cache.move_to_end(thread_id)
+            return self._thread_data_cache[thread_id], CacheMetrics.create_empty()
+
+        thread_json_file = self._get_thread_json_path(thread_id)
+        data, metrics = self._load_data_from_file(thread_json_file)
+        self._thread_data_cache[thread_id] = data
+        if len(self._thread_data_cache) > self.THREAD_DATA_CACHE_SIZE:
+            self._thread_data_cache.popitem(last=False)
+        return data, metrics
+
+    def _load_thread_data(self, thread_id: str, request_type: GmailRequestType = GmailRequestType.THREADS_LIST) -> Any:
+        """
+        Loads the cached data of a thread.
+        :return: The thread data, or None if the thread file can't be read, so the thread is fetched again
+        """
+        try:
+            data, metrics = self._get_thread_from_file_system(thread_id)
+        except (OSError, ValueError) as e:
+            LOG.warning("Cannot load file for thread: %s, it will be fetched again. Error: %s", thread_id, e)
+            return None
+        self._cache_actions_performed.add(request_type, metrics)
+        return data
 
     def actualize_cache_state(self, cache_state: CacheResultItems, thread_id: str, message_ids: List[str]):
-        message_ids_for_thread: List[str] = (
-            self.thread_to_message_data[thread_id].keys() if thread_id in self.thread_to_message_data else []
-        )
-        self.unknown_message_per_thread[thread_id] = set(message_ids).difference(message_ids_for_thread)
-        if self.unknown_message_per_thread[thread_id]:
+        unknown_messages: Set[str] = set(message_ids) - self._get_message_ids_for_thread(thread_id)
+        if unknown_messages:
+            self.unknown_message_per_thread[thread_id] = unknown_messages
+            cache_state.mark_partially_cached(thread_id)
+            return
+        # Only threads with unknown messages are tracked, so no empty set is kept for fully cached ones
+        self.unknown_message_per_thread.pop(thread_id, None)
+        # Thread is fully cached with all messages, unless its file can't be loaded
+        data = self._load_thread_data(thread_id, GmailRequestType.MESSAGES)
+        if data is None:
             cache_state.mark_partially_cached(thread_id)
         else:
-            # Thread is fully cached with all messages
-            data, metrics = self._get_thread_from_file_system(thread_id)
-            self._cache_actions_performed.add(GmailRequestType.MESSAGES, metrics)
             cache_state.mark_fully_cached(thread_id, data)
 
     @staticmethod
-    def _convert_thread_response_to_message_data_dicts(thread_response):
-        messages_response: List[Dict[str, Any]] = GH.get_field(thread_response, ThreadField.MESSAGES)
-        message_data_dicts: List[Dict[str, str]] = []
-        for msg in messages_response:
-            message_data_dicts.append(
-                {MESSAGE_ID: GH.get_field(msg, MessageField.ID), MESSAGE_DATE: GH.get_field(msg, MessageField.DATE)}
-            )
-        return message_data_dicts
+    def _convert_thread_response_to_index_rows(thread_id: str, thread_response) -> List[Tuple[str, str, str]]:
+        messages_response: List[Dict[str, Any]] = GH.get_field_value(thread_response, F_THREAD_MESSAGES)
+        # Plain dict lookups instead of GH.get_field calls, this runs for every message of every processed thread
+        return [(thread_id, msg.get(F_MSG_ID), msg.get(F_MSG_DATE)) for msg in messages_response]
 
     @staticmethod
     def _get_message_attachment_filename(message_id, attachment_id):
-        short_attachment_id = StringUtils.md5_hash(attachment_id)
-        return f"message_{message_id}_attachment_{short_attachment_id}.txt"
+        return _get_attachment_filename(message_id, attachment_id)
 
     def print_actions_performed(self):
         self._cache_actions_performed.print_all()
@@ -542,7 +932,7 @@ class NoCacheStrategy(CachingStrategy):
         return CacheResultItems(thread_ids, cache_type="thread").add_not_cached(thread_ids)
 
     def get_cache_state_for_message(self, thread_id: str, message_id: str, attachment_id: str):
-        return CacheResultItems([thread_id], cache_type="message").add_not_cached([message_id])
+        return CacheResultItems([message_id], cache_type="message attachment").add_not_cached([message_id])
 
     def fill_cache(self):
         LOG.debug(f"Invoked fill_cache of {type(self).__name__}")
@@ -558,6 +948,9 @@ class NoCacheStrategy(CachingStrategy):
     def print_actions_performed(self):
         LOG.info("No cache actions were performed!")
 
+    def flush(self):
+        LOG.debug(f"Invoked flush of {type(self).__name__}")
+
 
 class CachingStrategyType(Enum):
     NO_CACHE = NoCacheStrategy
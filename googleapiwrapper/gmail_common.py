@@ -1,9 +1,11 @@
 import enum
+import sys
 
-MESSAGE_DATE = "message_date"
-MESSAGE_ID = "message_id"
+MESSAGE_DATE = sys.intern("message_date")
+MESSAGE_ID = sys.intern("message_id")
 THREAD_JSON_FILENAME = "thread.json"
 MESSAGE_DATA_FILENAME = "message_data"
+MESSAGE_INDEX_DB_FILENAME = "message_index.db"
 THREADS_DIR_NAME = "threads"
 MESSAGES_DIR_NAME = "messages"
 
@@ -4,11 +4,14 @@ import sys
 from dataclasses import dataclass, field, InitVar
 import datetime
 from enum import Enum
-from typing import List, Dict, Any
+from itertools import chain
+from typing import List, Dict, Any, Tuple
 
-from googleapiwrapper.utils import Decoder
+from googleapiwrapper.utils import DATACLASS_SLOTS
 
 LOG = logging.getLogger(__name__)
+# Resolved lazily, as gmail_api imports this module
+_GMAIL_API_MODULE = None
 
 
 class ThreadQueryFormat(Enum):
@@ -76,7 +79,28 @@ class MimeType(Enum):
     TEXT_PLAIN = "text/plain"
 
 
-@dataclass
+# Field names of API responses, resolved once as they are read for every thread, message, part and header.
+# To be used with GenericObjectHelper.get_field_value
+F_HEADER_NAME = HeaderField.NAME.value
+F_HEADER_VALUE = HeaderField.VALUE.value
+F_BODY_SIZE = MessagePartBodyField.SIZE.value
+F_BODY_DATA = MessagePartBodyField.DATA.value
+F_BODY_ATTACHMENT_ID = MessagePartBodyField.ATTACHMENT_ID.value
+F_PART_ID = MessagePartField.PART_ID.value
+F_PART_MIME_TYPE = MessagePartField.MIME_TYPE.value
+F_PART_HEADERS = MessagePartField.HEADERS.value
+F_PART_BODY = MessagePartField.BODY.value
+F_PART_PARTS = MessagePartField.PARTS.value
+F_MSG_ID = MessageField.ID.value
+F_MSG_THREAD_ID = MessageField.THREAD_ID.value
+F_MSG_SNIPPET = MessageField.SNIPPET.value
+F_MSG_DATE = MessageField.DATE.value
+F_MSG_PAYLOAD = MessageField.PAYLOAD.value
+F_THREAD_ID = ThreadField.ID.value
+F_THREAD_MESSAGES = ThreadField.MESSAGES.value
+
+
+@dataclass(**DATACLASS_SLOTS)
 class MessagePartBody:
     data: str
     size: str
@@ -86,20 +110,26 @@ class MessagePartBody:
         return f"{{ size: {self.size}, attachment_id: {self.attachment_id} }}"
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Header:
     name: str
     value: str
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class MessagePart:
     id: str
     mime_type: str
-    headers: List[Header]
+    # Header names and values are stored as parallel tuples, so a header can be looked up with a single index call
+    header_names: Tuple[str, ...]
+    header_values: Tuple[str, ...]
     body: MessagePartBody
     parts: List[Any]  # Cannot refer to MessagePart :(
 
+    @property
+    def headers(self) -> List[Header]:
+        return [Header(name, value) for name, value in zip(self.header_names, self.header_values)]
+
     def short_str(self):
         return (
             f"{{ ID: {self.id}, "
@@ -110,7 +140,7 @@ class MessagePart:
         )
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Message:
     id: str
     thread_id: str
@@ -119,6 +149,12 @@ class Message:
     payload: MessagePart
     subject: str = field(init=False)
     message_parts: List[MessagePart] = field(init=False)
+    # Set in __post_init__, declared so they have slots. Left out of repr and eq like before.
+    sender: str = field(init=False, repr=False, compare=False)
+    sender_email: str = field(init=False, repr=False, compare=False)
+    recipient: str = field(init=False, repr=False, compare=False)
+    recipient_email: str = field(init=False, repr=False, compare=False)
+    date_str: str = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
         self.subject = self._get_subject_from_headers()
@@ -142,17 +178,24 @@ class Message:
         return self._get_field_from_headers("Date")
 
     def _get_field_from_headers(self, f_name):
-        for header in self.payload.headers:
-            if header.name == f_name:
-                return header.value
-        LOG.error("Header with name '%s' not found for message with thread ID: %s", f_name, self.thread_id)
-        return None
+        payload = self.payload
+        try:
+            return payload.header_values[payload.header_names.index(f_name)]
+        except ValueError:
+            LOG.error("Header with name '%s' not found for message with thread ID: %s", f_name, self.thread_id)
+            return None
 
-    def _get_all_msg_parts_recursive(self, msg_part: MessagePart):
+    @staticmethod
+    def _get_all_msg_parts_recursive(msg_part: MessagePart):
+        # Post-order (children before their parent), collected iteratively into a single list:
+        # Visiting parents first and pushing children in order yields the exact reverse of the post-order.
         lst: List[MessagePart] = []
-        for part in msg_part.parts:
-            lst += self._get_all_msg_parts_recursive(part)
-        lst.append(msg_part)
+        stack: List[MessagePart] = [msg_part]
+        while stack:
+            part = stack.pop()
+            lst.append(part)
+            stack.extend(part.parts)
+        lst.reverse()
         return lst
 
     def short_str(self):
@@ -179,7 +222,7 @@ class Message:
             return raw_str
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Thread:
     id: str
     subject: str
@@ -187,7 +230,7 @@ class Thread:
 
 
 # CUSTOM CLASSES
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class GmailMessageBodyPart:
     body_data: str
     mime_type: str
@@ -200,7 +243,7 @@ class GmailMessageBodyPart:
         return f"{{ mime_type: {self.mime_type} }}"
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class GmailMessage:
     msg_id: str
     thread_id: str
@@ -212,14 +255,18 @@ class GmailMessage:
     recipient_email: str
     date_str: str
     message_parts: InitVar[List[MessagePart]]
+    message_body_parts: List[GmailMessageBodyPart] = field(init=False, repr=False, compare=False)
 
     def __post_init__(self, message_parts):
         self.message_body_parts: List[GmailMessageBodyPart] = self._convert_message_parts(message_parts)
 
     @staticmethod
     def _get_conversion_context():
-        module = sys.modules["googleapiwrapper.gmail_api"]
-        return module.__getattribute__("CONVERSION_CONTEXT")
+        # gmail_api replaces CONVERSION_CONTEXT for every query, so only the module itself can be cached
+        global _GMAIL_API_MODULE
+        if _GMAIL_API_MODULE is None:
+            _GMAIL_API_MODULE = sys.modules["googleapiwrapper.gmail_api"]
+        return _GMAIL_API_MODULE.CONVERSION_CONTEXT
 
     @staticmethod
     def from_message(message: Message, thread_id: str):
@@ -244,7 +291,7 @@ class GmailMessage:
         for message_part in message_parts:
             CONVERSION_CONTEXT.register_current_message_part(message_part)
             mime_type: str = message_part.mime_type
-            body, decoding_successful, empty = self._decode_base64_encoded_body(message_part)
+            body, decoding_successful, empty = self._decode_base64_encoded_body(message_part, CONVERSION_CONTEXT)
             gmail_msg_body_part: GmailMessageBodyPart = GmailMessageBodyPart(body, mime_type)
             result.append(gmail_msg_body_part)
             if not decoding_successful:
@@ -253,24 +300,22 @@ class GmailMessage:
                 CONVERSION_CONTEXT.report_empty_body(self.thread_id, gmail_msg_body_part)
         return result
 
-    def _decode_base64_encoded_body(self, message_part: MessagePart):
+    def _decode_base64_encoded_body(self, message_part: MessagePart, conversion_context):
+        """
+        :return: Tuple of (decoded body data, whether decoding was successful, whether the body is empty)
+        """
         encoded_body_data = message_part.body.data
-        successful = True
-        empty = False
+        if not encoded_body_data:
+            # Common for multipart containers, their content is in the child parts
+            return "", True, True
         try:
-            if encoded_body_data:
-                decoded_body_data = Decoder.decode_base64_urlsafe(encoded_body_data)
-            else:
-                decoded_body_data = ""
-                empty = True
+            return conversion_context.decode_body(encoded_body_data), True, False
         except binascii.Error:
             LOG.exception(
                 f"Failed to parse base64 encoded data for message with ID: {self.msg_id}."
                 f"Storing original body data to object and storing original API object as well."
             )
-            decoded_body_data = encoded_body_data
-            successful = False
-        return decoded_body_data, successful, empty
+            return encoded_body_data, False, False
 
     def get_all_plain_text_parts(self) -> List[GmailMessageBodyPart]:
         return self.get_all_parts_with_type(MimeType.TEXT_PLAIN)
@@ -282,10 +327,11 @@ class GmailMessage:
     def _filter_by_mime_type(
         mime_type: MimeType, message_parts: List[GmailMessageBodyPart]
     ) -> List[GmailMessageBodyPart]:
-        return list(filter(lambda x: x.mime_type == mime_type.value, message_parts))
+        mime_type_value = mime_type.value
+        return [part for part in message_parts if part.mime_type == mime_type_value]
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class MessagePartDescriptor:
     message: Message
     message_part: MessagePart
@@ -306,7 +352,7 @@ class GmailThread:
         self.messages: List[GmailMessage] = messages
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class GmailThreads:
     threads: List[GmailThread] = field(default_factory=list)
 
@@ -317,7 +363,7 @@ class GmailThreads:
 
     @property
     def messages(self) -> List[GmailMessage]:
-        return [msg for t in self.threads for msg in t.messages]
+        return list(chain.from_iterable(t.messages for t in self.threads))
 
 
 class GenericObjectHelper:
@@ -331,3 +377,10 @@ class GenericObjectHelper:
             if not ret:
                 ret = default_val
             return ret
+
+    @staticmethod
+    def get_field_value(gmail_api_obj: Dict, field_value: str, default_val=None):
+        """
+        Same as get_field, but takes the value of the field Enum. Meant for loops, with the value resolved upfront.
+        """
+        return gmail_api_obj.get(field_value) or default_val
@@ -1,13 +1,17 @@
+import hashlib
+import json
 import logging
 import os
 import pickle
 import os.path
+import threading
 from dataclasses import dataclass
 from enum import Enum
-from typing import List
+from typing import Any, Dict, List, Tuple
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
 from pythoncommons.file_utils import FileUtils
 
@@ -20,6 +24,7 @@ LOG = logging.getLogger(__name__)
 class CredentialsFileType(Enum):
     CLIENT_SECRET = "client-secret"
     TOKEN_PICKLE = "token-pickle"
+    TOKEN_JSON = "token-json"
 
 
 @dataclass
@@ -35,8 +40,11 @@ class GoogleApiAuthorizer:
         "https://www.googleapis.com/auth/userinfo.profile",
         "https://www.googleapis.com/auth/userinfo.email",
     ]
-    # TODO If modifying these scopes, delete the file token.pickle.
+    # TODO If modifying these scopes, delete the token file.
     DEFAULT_WEBSERVER_PORT = 49555
+    # Built services of the current thread, shared by its API wrappers. Dropped together with the thread.
+    # Key: (service name, API version, token file path), value: (hash of the refresh token, service resource)
+    _THREAD_SERVICES = threading.local()
 
     def __init__(
         self,
@@ -53,7 +61,8 @@ class GoogleApiAuthorizer:
         self.project_name = project_name
         self._set_scopes(scopes)
         self.server_port = server_port
-        self.token_full_path = self._get_file_full_path(cred_file_type=CredentialsFileType.TOKEN_PICKLE)
+        self.token_full_path = self._get_file_full_path(cred_file_type=CredentialsFileType.TOKEN_JSON)
+        self.legacy_token_full_path = self._get_file_full_path(cred_file_type=CredentialsFileType.TOKEN_PICKLE)
         self.credentials_full_path = self._get_file_full_path(cred_file_type=CredentialsFileType.CLIENT_SECRET)
         LOG.info(
             f"Configuration of {type(self).__name__}:\n"
@@ -63,6 +72,7 @@ class GoogleApiAuthorizer:
             f"Scopes: {self.scopes}\n"
             f"Server port: {self.server_port}\n"
             f"Token file path (read/write): {self.token_full_path}\n"
+            f"Legacy token file path (read-only): {self.legacy_token_full_path}\n"
             f"Credentials file path (read-only): {self.credentials_full_path}\n"
         )
 
@@ -77,6 +87,13 @@ class GoogleApiAuthorizer:
                 "tokenpickles",
                 f"token_{self.project_name}_{account_dirname}.pickle",
             )
+        elif cred_file_type == CredentialsFileType.TOKEN_JSON:
+            return FileUtils.join_path(
+                self.secret_basedir,
+                self.project_name,
+                "tokens",
+                f"token_{self.project_name}_{account_dirname}.json",
+            )
 
     def _set_scopes(self, scopes):
         self.scopes = scopes
@@ -104,17 +121,83 @@ class GoogleApiAuthorizer:
             authed_session = self._handle_login(authed_session)
         return authed_session
 
-    def _load_token(self) -> AuthedSession:
+    def build_service(self, authed_session: AuthedSession, api_version: str):
+        """
+        Builds the service resource of the service type, or returns the one built earlier for the same account.
+        Services are only rebuilt if the account logged in again, as access token refreshes happen in place.
+        A service resource is not thread-safe (its httplib2.Http is not), so services are never shared across threads.
+        The returned service uses the credentials of the session it was first built with.
+        """
+        creds = authed_session.authed_creds
+        service_name = self.service_type.service_name
+        key = (service_name, api_version, self.token_full_path)
+        # Only a hash of the refresh token is kept, it is enough to tell whether the account logged in again
+        token_hash = hashlib.sha256((creds.refresh_token or "").encode()).hexdigest()
+        services = self._get_thread_services()
+        cached = services.get(key)
+        if cached is not None and cached[0] == token_hash:
+            return cached[1]
+        # A service built with the credentials of an earlier login is replaced, not kept next to the new one
+        service = build(service_name, api_version, credentials=creds, static_discovery=True)
+        services[key] = (token_hash, service)
+        return service
+
+    @classmethod
+    def _get_thread_services(cls) -> Dict[Tuple[str, str, str], Tuple[str, Any]]:
+        services = getattr(cls._THREAD_SERVICES, "services", None)
+        if services is None:
+            services = cls._THREAD_SERVICES.services = {}
+        return services
+
+    @classmethod
+    def clear_service_cache(cls):
         """
-        The file token.pickle stores the user's access and refresh tokens, and is
+        Drops the services cached for the current thread, e.g. when the credentials were revoked.
+        Services of other threads are dropped when their thread finishes.
+        """
+        cls._get_thread_services().clear()
+
+    def _load_token(self) -> AuthedSession or None:
+        """
+        The token file stores the user's access and refresh tokens, and is
         created automatically when the authorization flow completes for the first
         time.
+        Tokens saved by earlier versions were pickled, these are still loaded if there is no JSON token yet.
+        An invalid token file is treated as if there was no token, so the user is asked to log in again.
         """
-        authed_session: AuthedSession or None = None
         LOG.debug("Loading token from file: %s", self.token_full_path)
-        if os.path.exists(self.token_full_path):
+        try:
             with open(self.token_full_path, "rb") as token:
-                authed_session = pickle.load(token)
+                token_data = json.loads(token.read())
+        except FileNotFoundError:
+            return self._load_legacy_token()
+        except json.JSONDecodeError as e:
+            LOG.error("Failed to parse token file: %s. Error: %s", self.token_full_path, e)
+            return None
+        try:
+            return AuthedSession(
+                Credentials.from_authorized_user_info(token_data["credentials"]),
+                token_data["user_email"],
+                token_data["user_name"],
+                token_data["project_name"],
+            )
+        except (ValueError, KeyError) as e:
+            LOG.error("Invalid token file: %s. Error: %s", self.token_full_path, e)
+            return None
+
+    def _load_legacy_token(self) -> AuthedSession or None:
+        LOG.debug("Loading legacy token from file: %s", self.legacy_token_full_path)
+        try:
+            with open(self.legacy_token_full_path, "rb") as token:
+                authed_session: AuthedSession = pickle.load(token)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError) as e:
+            # Truncated file or pickled with incompatible classes, the user is asked to log in again
+            LOG.warning("Failed to load legacy token file: %s. Error: %s", self.legacy_token_full_path, e)
+            return None
+        # Migrate, so the legacy token is not read again
+        self._write_token(authed_session)
         return authed_session
 
     def _handle_login(self, authed_session: AuthedSession) -> AuthedSession:
@@ -135,5 +218,15 @@ class GoogleApiAuthorizer:
 
     def _write_token(self, authed_session: AuthedSession):
         FileUtils.ensure_dir_created(FileUtils.get_parent_dir_name(self.token_full_path))
-        with open(self.token_full_path, "wb") as token:
-            pickle.dump(authed_session, token)
+        token_data = {
+            "credentials": json.loads(authed_session.authed_creds.to_json()),
+            "user_email": authed_session.user_email,
+            "user_name": authed_session.user_name,
+            "project_name": authed_session.project_name,
+        }
+        # The token file contains the refresh token and the client secret, so only the owner may read it
+        fd = os.open(self.token_full_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as token:
+            json.dump(token_data, token)
+        # The mode passed to os.open only applies to newly created files
+        os.chmod(self.token_full_path, 0o600)
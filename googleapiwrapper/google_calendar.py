@@ -3,44 +3,52 @@ import datetime
 import json
 import logging
 from dataclasses import dataclass
-from typing import Optional, Any, Union
+from functools import lru_cache
+from typing import Optional, Any, Union, List, Tuple, Dict
 
-from googleapiclient.discovery import build
 from googleapiwrapper.common import ServiceType
 from googleapiwrapper.google_auth import GoogleApiAuthorizer
+from googleapiwrapper.utils import DATACLASS_SLOTS
 
 LOG = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
 def get_timezone():
-    import datetime
-
-    now = datetime.datetime.now()
-    local_now = now.astimezone()
-    local_tz = local_now.tzinfo
-    local_tzname = local_tz.tzname(local_now)
-    return local_tzname
+    # Resolved once per process. A DST switch while the process runs is not picked up.
+    local_now = datetime.datetime.now().astimezone()
+    return local_now.tzinfo.tzname(local_now)
 
 
 class EnhancedJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o, dict_factory=lambda x: {k: v for (k, v) in x if v is not None})
+            # Only the top level is converted, the encoder calls default again for nested dataclasses
+            values = ((f.name, getattr(o, f.name)) for f in dataclasses.fields(o))
+            return {k: v for (k, v) in values if v is not None}
         return super().default(o)
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class CalendarDateTime:
     dateTime: str
     timeZone: Optional[str] = None
 
+    def to_body(self) -> Dict[str, str]:
+        if self.timeZone is None:
+            return {"dateTime": self.dateTime}
+        return {"dateTime": self.dateTime, "timeZone": self.timeZone}
+
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class CalendarDate:
     date: str
 
+    def to_body(self) -> Dict[str, str]:
+        return {"date": self.date}
+
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class CalendarEvent:
     """
     event = {
@@ -80,10 +88,33 @@ class CalendarEvent:
     attendees: Optional[Any] = None
     reminders: Optional[Any] = None
 
+    def to_body(self) -> Dict[str, Any]:
+        """
+        Request body of the event for the Calendar API. Unset optional fields are left out.
+        Built directly instead of with dataclasses.asdict, which deep-copies the whole event.
+        """
+        body = {
+            "summary": self.summary,
+            "description": self.description,
+            "start": self.start.to_body(),
+            "end": self.end.to_body(),
+        }
+        if self.location is not None:
+            body["location"] = self.location
+        if self.recurrence is not None:
+            body["recurrence"] = self.recurrence
+        if self.attendees is not None:
+            body["attendees"] = self.attendees
+        if self.reminders is not None:
+            body["reminders"] = self.reminders
+        return body
+
 
 class CalendarApiWrapper:
     DEFAULT_API_VERSION = "v3"
     DEFAULT_PAGE_SIZE = 100
+    # Max. number of requests the Calendar API accepts in a single batch request
+    MAX_BATCH_SIZE = 50
 
     def __init__(
         self,
@@ -97,11 +128,7 @@ class CalendarApiWrapper:
         self.events_service = self.service.events()
 
     def _build_service(self, api_version, authorizer):
-        return build(
-            authorizer.service_type.service_name,
-            api_version,
-            credentials=self.authed_session.authed_creds,
-        )
+        return authorizer.build_service(self.authed_session, api_version)
 
     def list_events(self, min_time, max_results=100, single_events=True, order_by="startTime"):
         events_result = self.events_service.list(
@@ -124,13 +151,15 @@ class CalendarApiWrapper:
         Prints the start and name of the next 10 events on the user's calendar.
         """
         # Call the Calendar API
-        now = datetime.datetime.utcnow().isoformat() + "Z"  # 'Z' indicates UTC time
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()  # RFC3339 timestamp with UTC offset
         LOG.info("Getting the upcoming %d events", max_results)
         events = self.list_events(min_time=now, max_results=max_results)
 
         # Prints the start and name of the next 10 events
         for event in events:
-            start = event["start"].get("dateTime", event["start"].get("date"))
+            event_start = event["start"]
+            # Timed events have a dateTime, all-day events only have a date
+            start = event_start["dateTime"] if "dateTime" in event_start else event_start.get("date")
             LOG.info("EVENT: %s %s", start, event["summary"])
 
     def test_create_event(self):
@@ -144,7 +173,7 @@ class CalendarApiWrapper:
 
         #event_json = json.dumps(event_obj, cls=EnhancedJSONEncoder)
         #print(event_json)
-        event = self.events_service.insert(calendarId='primary', body=dataclasses.asdict(event_obj)).execute()
+        event = self.events_service.insert(calendarId='primary', body=event_obj.to_body()).execute()
         LOG.info('Event created: %s' % (event.get('htmlLink')))
 
     def create_all_day_event(self, summary, description, start: CalendarDate, end: CalendarDate):
@@ -152,5 +181,39 @@ class CalendarApiWrapper:
                                   description=description,
                                   start=start,
                                   end=end)
-        event = self.events_service.insert(calendarId='primary', body=dataclasses.asdict(event_obj)).execute()
+        event = self.events_service.insert(calendarId='primary', body=event_obj.to_body()).execute()
         LOG.info('Event created: %s' % (event.get('htmlLink')))
+
+    def create_all_day_events(
+        self, events: List[Tuple[str, str, CalendarDate, CalendarDate]]
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        Creates multiple all-day events with one batch request per MAX_BATCH_SIZE events, instead of a request per event.
+        Failed events don't stop the others from being created, so only the failed ones should be retried.
+        :param events: Tuples of (summary, description, start, end)
+        :return: In the order of the given events, the created event or the exception (e.g. HttpError) of the failed one
+        """
+        results: List[Union[Dict[str, Any], Exception]] = [None] * len(events)
+
+        def _on_event_created(request_id, event, exception):
+            idx = int(request_id)
+            if exception is not None:
+                LOG.error("Failed to create event '%s': %s", events[idx][0], exception)
+                results[idx] = exception
+            else:
+                LOG.info("Event created: %s", event.get("htmlLink"))
+                results[idx] = event
+
+        for i in range(0, len(events), self.MAX_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=_on_event_created)
+            for idx, (summary, description, start, end) in enumerate(events[i : i + self.MAX_BATCH_SIZE], start=i):
+                event_obj = CalendarEvent(summary=summary, description=description, start=start, end=end)
+                batch.add(
+                    self.events_service.insert(calendarId="primary", body=event_obj.to_body()), request_id=str(idx)
+                )
+            batch.execute()
+
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        if failed:
+            LOG.error("Failed to create %d of %d events", failed, len(events))
+        return results
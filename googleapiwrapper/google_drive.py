@@ -1,15 +1,16 @@
 import io
 import logging
 import os
+import string
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Dict, Any
+from functools import lru_cache
+from types import MappingProxyType
+from typing import List, Dict, Any, Tuple
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.http import MediaIoBaseDownload
-from pythoncommons.file_utils import FileUtils
 from pythoncommons.object_utils import ObjUtils
 from pythoncommons.string_utils import auto_str, StringUtils
 
@@ -17,6 +18,14 @@ from googleapiwrapper.google_auth import GoogleApiAuthorizer
 
 LOG = logging.getLogger(__name__)
 OP_SETTINGS_ARG_NAME = "op_settings"
+# Characters kept by StringUtils.replace_special_chars, names consisting only of these are returned as they are
+_VALID_NAME_CHARS = frozenset("-_.() " + string.ascii_letters + string.digits)
+
+
+def _sanitize_name(name):
+    if isinstance(name, str) and _VALID_NAME_CHARS.issuperset(name):
+        return name
+    return StringUtils.replace_special_chars(name)
 
 
 def capture_single_operation_settings(func):
@@ -102,14 +111,15 @@ class DriveApiMimeTypes:
     }
 
     EXT_TO_MIME_MAPPINGS = {"json": NormalMimeType.APPLICATION_JSON}
+    _EXT_TO_MIME = {k.lower(): v for k, v in EXT_TO_MIME_MAPPINGS.items()}
 
     @classmethod
     def get_mime_type_by_filename(cls, filename):
-        ext = FileUtils.get_file_extension(filename)
-        if ext in cls.EXT_TO_MIME_MAPPINGS:
-            return cls.EXT_TO_MIME_MAPPINGS[ext]
+        _, sep, ext = filename.rpartition(".")
+        if not sep:
+            ext = ""
         # Fallback to default MIME type
-        return NormalMimeType.APPLICATION_OCTET_STREAM
+        return cls._EXT_TO_MIME.get(ext.lower(), NormalMimeType.APPLICATION_OCTET_STREAM)
 
 
 class FileField:
@@ -159,6 +169,14 @@ class GenericUserField:
     DISPLAY_NAME = "displayName"
 
 
+_UNKNOWN_USER = MappingProxyType(
+    {
+        GenericUserField.EMAIL_ADDRESS: GenericUserField.UNKNOWN_USER,
+        GenericUserField.DISPLAY_NAME: GenericUserField.UNKNOWN_USER,
+    }
+)
+
+
 class GenericApiField:
     PAGING_NEXT_PAGE_TOKEN = "nextPageToken"
 
@@ -172,10 +190,10 @@ class DriveApiUser(dict):
         display_name_field = GenericUserField.DISPLAY_NAME
         unknown_user = GenericUserField.UNKNOWN_USER
 
-        email = owner_dict[email_field] if email_field in owner_dict else unknown_user
-        name = owner_dict[display_name_field] if display_name_field in owner_dict else unknown_user
+        email = owner_dict.get(email_field, unknown_user)
+        name = owner_dict.get(display_name_field, unknown_user)
         self.email = email
-        self.name = StringUtils.replace_special_chars(name)
+        self.name = _sanitize_name(name)
 
     def __repr__(self):
         return self.__str__()
@@ -200,7 +218,7 @@ class DriveApiFile:
     ):
         super(DriveApiFile, self).__init__()
         self.id = id
-        self.name = StringUtils.replace_special_chars(name)
+        self.name = _sanitize_name(name)
         self.link = link
         self.created_date = created_date
         self.modified_date = modified_date
@@ -208,7 +226,8 @@ class DriveApiFile:
         self.mime_type = mime_type
         self.owners = owners
 
-        sharing_user.name = StringUtils.replace_special_chars(sharing_user.name)
+        if sharing_user is not None:
+            sharing_user.name = _sanitize_name(sharing_user.name)
         self.sharing_user = sharing_user
         self.size = size
         self.parents = parents
@@ -281,27 +300,18 @@ class DriveFileStructure:
             self.add_file(parent)
 
         path_folders = initial_path.split(os.sep)
-        self.path_folders = self._sanitize(path_folders)
+        self.path_folders: Tuple[str, ...] = self._sanitize(path_folders)
         self.drive_api_files: List[DriveApiFile] = []
-        self._index = 0
-        self._count = len(self.path_folders)
 
     @staticmethod
     def _sanitize(path_folders):
-        return [f for f in path_folders if f]
+        return tuple(f for f in path_folders if f)
 
     def __len__(self):
         return len(self.drive_api_files)
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self._index == self._count:
-            raise StopIteration
-        result = self.path_folders[self._index]
-        self._index += 1
-        return result
+        return iter(self.path_folders)
 
     def get_last_file_or_dir(self) -> DriveApiFile or None:
         if len(self.drive_api_files) > 0:
@@ -315,13 +325,26 @@ class DriveFileStructure:
         self.drive_api_files.append(drive_api_file)
 
 
+class _DrivePathTrieNode:
+    __slots__ = ("drive_file", "children")
+
+    def __init__(self, drive_file: DriveApiFile = None):
+        self.drive_file: DriveApiFile or None = drive_file
+        self.children: Dict[str, "_DrivePathTrieNode"] = {}
+
+
 class DriveApiWrapper:
     DEFAULT_API_VERSION = "v3"
     DEFAULT_ORDER_BY = "sharedWithMeTime desc"
     QUERY_SHARED_WITH_ME = "sharedWithMe"
     DEFAULT_PAGE_SIZE = 100
-    DRIVE_API_FILE_CACHE: Dict[str, DriveApiFile] = {}
+    # Max. number of requests the Drive API accepts in a single batch request
+    MAX_BATCH_SIZE = 100
+    # Cached folders, keyed by path components, e.g. 'a' -> 'b' -> 'docs' for folder 'a/b/docs'
+    DRIVE_API_FILE_CACHE: _DrivePathTrieNode = _DrivePathTrieNode()
     DRIVE_API_FILE_CACHE_BY_ID: Dict[str, DriveApiFile] = {}
+    # Key: ID of a folder in DRIVE_API_FILE_CACHE, value: path components of the folder
+    DRIVE_API_FILE_PATH_BY_ID: Dict[str, Tuple[str, ...]] = {}
 
     def __init__(
         self,
@@ -339,11 +362,7 @@ class DriveApiWrapper:
         self.final_settings: _DriveApiWrapperFinalSettings or None = None
 
     def _build_service(self, api_version, authorizer):
-        return build(
-            authorizer.service_type.service_name,
-            api_version,
-            credentials=self.authed_session.authed_creds,
-        )
+        return authorizer.build_service(self.authed_session, api_version)
 
     def _evaluate_to_final_settings(self) -> _DriveApiWrapperFinalSettings:
         LOG.debug("Current session settings: %s", self.session_settings)
@@ -384,19 +403,62 @@ class DriveApiWrapper:
             return current_op_value
         return session_value
 
-    def _add_dir_to_cache(self, dir_name, drive_file: DriveApiFile):
-        # TODO consider adding not only dir names as key but with dir name + google drive path?
+    def _add_dir_to_cache(self, path_folders: Tuple[str, ...], drive_file: DriveApiFile):
+        # Keyed by the full path, as folders with the same name can exist under different parents
         if not drive_file:
-            raise ValueError("Cannot add None object to cache! Dir name was: {}".format(dir_name))
-        LOG.debug("Adding dir '%s' to cache, drive file: '%s'", dir_name, drive_file)
-        self.DRIVE_API_FILE_CACHE[dir_name] = drive_file
+            raise ValueError("Cannot add None object to cache! Dir path was: {}".format(os.sep.join(path_folders)))
+        LOG.debug("Adding dir '%s' to cache, drive file: '%s'", os.sep.join(path_folders), drive_file)
+        node = self.DRIVE_API_FILE_CACHE
+        for folder_name in path_folders:
+            node = node.children.setdefault(folder_name, _DrivePathTrieNode())
+        node.drive_file = drive_file
+        self.DRIVE_API_FILE_PATH_BY_ID[drive_file.id] = tuple(path_folders)
+        self._add_dir_to_cache_by_id(drive_file)
+
+    def _add_dir_to_cache_by_id(self, drive_file: DriveApiFile):
+        LOG.debug("Adding dir to cache by id: %s", drive_file.id)
         self.DRIVE_API_FILE_CACHE_BY_ID[drive_file.id] = drive_file
 
-    def _load_dir_from_cache(self, dir_name) -> DriveApiFile or None:
-        LOG.debug("Loading dir '%s' from cache", dir_name)
-        if dir_name in self.DRIVE_API_FILE_CACHE:
-            return self.DRIVE_API_FILE_CACHE[dir_name]
-        return None
+    def _load_cached_dirs(self, path_folders: Tuple[str, ...]) -> List[DriveApiFile]:
+        """
+        Returns the cached folders along the longest cached prefix of the path, starting from the top-level folder.
+        """
+        LOG.debug("Loading dirs of path '%s' from cache", os.sep.join(path_folders))
+        cached_dirs: List[DriveApiFile] = []
+        node = self.DRIVE_API_FILE_CACHE
+        for folder_name in path_folders:
+            node = node.children.get(folder_name)
+            if not node or not node.drive_file:
+                break
+            cached_dirs.append(node.drive_file)
+        return cached_dirs
+
+    def _remove_dir_from_cache(self, drive_file: DriveApiFile):
+        if drive_file.mime_type and drive_file.mime_type != DriveApiMimeType.FOLDER.value:
+            # Only folders are cached
+            return
+        self.DRIVE_API_FILE_CACHE_BY_ID.pop(drive_file.id, None)
+        path_folders = self.DRIVE_API_FILE_PATH_BY_ID.pop(drive_file.id, None)
+        if not path_folders:
+            return
+        parent_node = self.DRIVE_API_FILE_CACHE
+        for folder_name in path_folders[:-1]:
+            parent_node = parent_node.children.get(folder_name)
+            if not parent_node:
+                return
+        node = parent_node.children.get(path_folders[-1])
+        if not node or not node.drive_file or node.drive_file.id != drive_file.id:
+            return
+        LOG.debug("Removing dir '%s' from cache", os.sep.join(path_folders))
+        del parent_node.children[path_folders[-1]]
+        # A removed folder invalidates the cached entries of its whole subtree
+        nodes = list(node.children.values())
+        while nodes:
+            node = nodes.pop()
+            if node.drive_file:
+                self.DRIVE_API_FILE_CACHE_BY_ID.pop(node.drive_file.id, None)
+                self.DRIVE_API_FILE_PATH_BY_ID.pop(node.drive_file.id, None)
+            nodes.extend(node.children.values())
 
     def _load_dir_from_cache_by_id(self, id: str) -> DriveApiFile or None:
         LOG.debug("Loading dir from cache by id: %s", id)
@@ -433,7 +495,17 @@ class DriveApiWrapper:
     @staticmethod
     def _get_field_names(fields, operation_type):
         if not fields:
-            fields = DriveApiWrapper._get_default_fields()
+            return DriveApiWrapper._get_default_field_names(operation_type)
+        return DriveApiWrapper._build_field_names(fields, operation_type)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _get_default_field_names(operation_type):
+        # Almost every request uses the default fields, so the field names string is built only once per operation type
+        return DriveApiWrapper._build_field_names(DriveApiWrapper._get_default_fields(), operation_type)
+
+    @staticmethod
+    def _build_field_names(fields, operation_type):
         if operation_type == DriveApiOperationType.QUERY:
             return DriveApiWrapper.get_field_names_with_pagination(fields)
         elif operation_type == DriveApiOperationType.UPLOAD_OR_CREATE:
@@ -479,6 +551,27 @@ class DriveApiWrapper:
             query += " and trashed != true"
         return self.list_files_with_paging(query, page_size, fields_str, order_by, resolve_parents=resolve_parents)
 
+    def _get_folders_by_names(
+        self,
+        names: List[str],
+        page_size=DEFAULT_PAGE_SIZE,
+        fields: List[str] = None,
+        order_by: str = DEFAULT_ORDER_BY,
+    ) -> List[DriveApiFile]:
+        # Not decorated with capture_single_operation_settings, as that would reset the settings of the caller's operation
+        final_settings = self.final_settings or self._evaluate_to_final_settings()
+        fields_str = self._get_field_names(fields, operation_type=DriveApiOperationType.QUERY)
+        names_query = " or ".join(f"name = '{self._escape_query_value(name)}'" for name in dict.fromkeys(names))
+        query: str = f"mimeType = '{DriveApiMimeType.FOLDER.value}' and ({names_query})"
+        if final_settings.file_find_mode == FileFindMode.JUST_UNTRASHED:
+            query += " and trashed != true"
+        return self.list_files_with_paging(query, page_size, fields_str, order_by)
+
+    @staticmethod
+    def _escape_query_value(value: str) -> str:
+        # https://developers.google.com/drive/api/guides/search-files: escape backslashes and single quotes
+        return value.replace("\\", "\\\\").replace("'", "\\'")
+
     def _get_file_internal(self, drive_path) -> List[DriveApiFile]:
         dirnames, filename = self._validate_upload_file_candidate(drive_path)
         structure: DriveFileStructure = self._verify_all_dirs_exist(dirnames)
@@ -512,17 +605,7 @@ class DriveApiWrapper:
                     DriveApiWrapper._convert_to_drive_file_object(i) for i in api_file_results
                 ]
                 if resolve_parents:
-                    for drive_api_file in drive_api_files:
-                        if drive_api_file.parents:
-                            LOG.debug("Resolving parent of DriveApiFile: %s", drive_api_file)
-                            parent_id = drive_api_file.parents[0]
-                            if parent_id in self.DRIVE_API_FILE_CACHE_BY_ID:
-                                drive_api_file._parent = self._load_dir_from_cache_by_id(parent_id)
-                                continue
-                            get_result = self._get_file_by_id(parent_id)
-                            parent_api_file = DriveApiWrapper._convert_to_drive_file_object(get_result)
-                            drive_api_file._parent = parent_api_file
-                            self._add_dir_to_cache(parent_api_file.name, parent_api_file)
+                    self._resolve_parents(drive_api_files)
                 result_files.extend(drive_api_files)
             else:
                 LOG.warning("No files found.")
@@ -530,6 +613,44 @@ class DriveApiWrapper:
 
         return result_files
 
+    def _resolve_parents(self, drive_api_files: List[DriveApiFile]):
+        missing_parent_ids = {
+            f.parents[0] for f in drive_api_files if f.parents and f.parents[0] not in self.DRIVE_API_FILE_CACHE_BY_ID
+        }
+        if missing_parent_ids:
+            for parent_api_file in self._get_files_by_ids(missing_parent_ids).values():
+                # The full path of the parent is unknown here, so it can only be cached by its ID
+                self._add_dir_to_cache_by_id(parent_api_file)
+
+        for drive_api_file in drive_api_files:
+            if drive_api_file.parents:
+                LOG.debug("Resolving parent of DriveApiFile: %s", drive_api_file)
+                drive_api_file._parent = self._load_dir_from_cache_by_id(drive_api_file.parents[0])
+
+    def _get_files_by_ids(self, ids) -> Dict[str, DriveApiFile]:
+        """
+        Fetches multiple files with one batch request per MAX_BATCH_SIZE IDs, instead of a request per file.
+        Files that could not be fetched are logged and left out of the result.
+        """
+        results: Dict[str, DriveApiFile] = {}
+
+        def _on_file_fetched(request_id, response, exception):
+            if exception is not None:
+                LOG.error("Failed to get file with ID %s: %s", request_id, exception)
+            else:
+                results[request_id] = DriveApiWrapper._convert_to_drive_file_object(response)
+
+        ids = list(ids)
+        for i in range(0, len(ids), self.MAX_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=_on_file_fetched)
+            for file_id in ids[i : i + self.MAX_BATCH_SIZE]:
+                batch.add(
+                    self.files_service.get(fileId=file_id, fields=FileField.GOOGLE_API_FIELDS_COMMA_SEPARATED),
+                    request_id=file_id,
+                )
+            batch.execute()
+        return results
+
     @capture_single_operation_settings
     def does_file_exist(
         self,
@@ -622,18 +743,30 @@ class DriveApiWrapper:
 
     def _verify_all_dirs_exist(self, dirnames):
         structure: DriveFileStructure = DriveFileStructure(os.sep.join(dirnames))
-        for folder_name in structure:
+        # Start from the deepest cached folder, only the remaining folders need to be looked up
+        for cached_dir in self._load_cached_dirs(structure.path_folders):
+            structure.add_file(cached_dir)
+        num_cached = len(structure)
+        uncached_names = structure.path_folders[num_cached:]
+
+        # Look up all uncached folders with a single query, the parent chain is resolved locally from the results
+        folders_by_name: Dict[str, List[DriveApiFile]] = {}
+        if uncached_names:
+            for folder in self._get_folders_by_names(uncached_names):
+                folders_by_name.setdefault(folder.name, []).append(folder)
+
+        for idx, folder_name in enumerate(uncached_names, start=num_cached):
             if structure.has_any_file():
                 parent_drive_file = structure.get_last_file_or_dir()
             else:
                 parent_drive_file = None
-            cached_dir: DriveApiFile = self._load_dir_from_cache(folder_name)
-            if cached_dir:
-                structure.add_file(cached_dir)
-                continue
-            found_folders: List[DriveApiFile] = self._get_files(
-                folder_name, mimetype=DriveApiMimeType.FOLDER, parent=parent_drive_file
-            )
+            # DriveApiFile names are sanitized, so the lookup key has to be sanitized as well
+            found_folders: List[DriveApiFile] = folders_by_name.get(StringUtils.replace_special_chars(folder_name), [])
+            if parent_drive_file:
+                found_folders = [f for f in found_folders if f.parents and parent_drive_file.id in f.parents]
+            if len(found_folders) != 1:
+                # Can't be resolved locally (missing or ambiguous), let the API decide about the folder under the parent
+                found_folders = self._get_files(folder_name, mimetype=DriveApiMimeType.FOLDER, parent=parent_drive_file)
             if not found_folders:
                 return structure
             if len(found_folders) > 2:
@@ -643,7 +776,7 @@ class DriveApiWrapper:
                 )
             current_drive_file = found_folders[0]
             structure.add_file(current_drive_file)
-            self._add_dir_to_cache(folder_name, current_drive_file)
+            self._add_dir_to_cache(structure.path_folders[: idx + 1], current_drive_file)
         return structure
 
     # TODO Move to DriveFileStructure ?
@@ -679,30 +812,32 @@ class DriveApiWrapper:
                 # File exists, remove it as one Google drive folder can have multiple files with the same name!
                 request = self.files_service.delete(fileId=file.id)
                 response = request.execute()
+                self._remove_dir_from_cache(file)
                 # TODO
                 print(response)
 
     def remove_file(self, file: DriveApiFile):
         request = self.files_service.delete(fileId=file.id)
         response = request.execute()
+        self._remove_dir_from_cache(file)
         # TODO Handle response / error handling
         print(response)
 
     def _create_folder_structure(self, path: str) -> DriveFileStructure:
         structure: DriveFileStructure = DriveFileStructure(path)
-        for folder_name in structure:
+        for cached_drive_dir in self._load_cached_dirs(structure.path_folders):
+            structure.add_file(cached_drive_dir)
+        num_cached = len(structure)
+
+        for idx, folder_name in enumerate(structure.path_folders[num_cached:], start=num_cached):
             if structure.has_any_file():
                 parent_drive_dir = structure.get_last_file_or_dir()
             else:
                 parent_drive_dir = None
-            cached_drive_dir: DriveApiFile = self._load_dir_from_cache(folder_name)
-            if cached_drive_dir:
-                structure.add_file(cached_drive_dir)
-                continue
             drive_api_file: DriveApiFile = self._create_or_find_folder(folder_name, parent_drive_file=parent_drive_dir)
             drive_api_file._parent = parent_drive_dir
             structure.add_file(drive_api_file)
-            self._add_dir_to_cache(folder_name, drive_api_file)
+            self._add_dir_to_cache(structure.path_folders[: idx + 1], drive_api_file)
         return structure
 
     def _create_or_find_folder(self, name: str, parent_drive_file: DriveApiFile) -> DriveApiFile:
@@ -747,11 +882,7 @@ class DriveApiWrapper:
             list_of_owners_dicts = {}
         owners = [DriveApiUser(owner_dict) for owner_dict in list_of_owners_dicts]
 
-        unknown_user = {
-            GenericUserField.EMAIL_ADDRESS: GenericUserField.UNKNOWN_USER,
-            GenericUserField.DISPLAY_NAME: GenericUserField.UNKNOWN_USER,
-        }
-        sharing_user_dict = item[FileField.SHARING_USER] if FileField.SHARING_USER in item else unknown_user
+        sharing_user_dict = item.get(FileField.SHARING_USER) or _UNKNOWN_USER
         sharing_user = DriveApiUser(sharing_user_dict)
 
         return DriveApiFile(
@@ -770,9 +901,7 @@ class DriveApiWrapper:
 
     @staticmethod
     def _safe_get(d: Dict[str, str], key: str):
-        if key not in d:
-            return None
-        return d[key]
+        return d.get(key)
 
     def download_file(self, file_id):
         """Downloads a file
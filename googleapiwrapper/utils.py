@@ -1,8 +1,12 @@
 import base64
+import binascii
 import email
 import logging
+import sys
 
 LOG = logging.getLogger(__name__)
+# Dataclass slots are only supported from Python 3.10, older versions fall back to instance dicts
+DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
 
 class CommonUtils:
@@ -12,6 +16,9 @@ class CommonUtils:
 
 
 class Decoder:
+    # Maps the URL-safe base64 alphabet used by the Gmail API to the standard one
+    _URLSAFE_TO_STANDARD = bytes.maketrans(b"-_", b"+/")
+
     @staticmethod
     def decode_base64(encoded):
         decoded_data = base64.b64decode(encoded)
@@ -20,7 +27,10 @@ class Decoder:
     @staticmethod
     def decode_base64_urlsafe(encoded):
         # https://www.daimto.com/how-to-read-gmail-message-body-with-python/
-        decoded = base64.urlsafe_b64decode(encoded)
+        # Same as base64.urlsafe_b64decode, without its wrapper calls and repeated argument conversions
+        if isinstance(encoded, str):
+            encoded = encoded.encode("ascii")
+        decoded = binascii.a2b_base64(encoded.translate(Decoder._URLSAFE_TO_STANDARD))
         mime_msg = email.message_from_bytes(decoded)
 
         # Find full message body